@@ -14,7 +14,9 @@ from pymoo.model.problem import Problem
 from pymoo.algorithms.nsga2 import NSGA2
 from pymoo.util.termination.default import MultiObjectiveDefaultTermination
 from pymoo.optimize import minimize
-from run_tools import create_epidemic_model, Policy
+from pymoo.util.display import MultiObjectiveDisplay
+from run_tools import create_epidemic_model, Policy, solve_objective_outputs, ParallelSolver, EvaluationCache, \
+    run_parameters_hash, PolicySchema, save_policy_schema
 
 import pandas as pd
 import argparse
@@ -24,6 +26,18 @@ parser = argparse.ArgumentParser(description='Run optimization run using an NSGA
 parser.add_argument('max_gen', type=int, help='maximum number of generations for NSGA-II algorithm.')
 parser.add_argument('runs', type=str, nargs='+', help='names of runs to run. See run_definitions.py for list of runs.')
 parser.add_argument('--file_suffix', type=str, help='suffix to add to file name - helps in separating result files')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes used to evaluate each generation (default: 1, no parallelism)')
+parser.add_argument('--prefix_nodes', type=int, default=0,
+                    help='max number of stored policy history segments for resuming policies that share their early '
+                         'control values with earlier solved ones (default: 0, no reuse). With reuse, policies are '
+                         'solved with their full history instead of the lean objective solver, which takes more memory '
+                         'per evaluated policy')
+parser.add_argument('--cache_size', type=int, default=10000,
+                    help='max number of evaluated individuals kept in the evaluation cache (default: 10000, 0 disables)')
+parser.add_argument('--cache_resolution', type=float, default=1e-6,
+                    help='decision variables closer than this fraction of their range share cache entries '
+                         '(default: 1e-6)')
 args = parser.parse_args()
 
 epidemic_simulators = {}
@@ -41,6 +55,9 @@ print("Will optimize: ", arg_runs)
 
 runs = get_runs_definitions()
 
+# objective and constraint values of evaluated individuals, shared by all runs (keys include run parameters)
+evaluation_cache = EvaluationCache(args.cache_size, args.cache_resolution) if args.cache_size > 0 else None
+
 #### OPTIMIZATION ENGINE ###
 # MODIFY ONLY IF YOU KNOW WHAT YOU'RE _DOING
 # Modifications here affect how the optimizer works, not run definitions
@@ -49,9 +66,13 @@ class COVID_policy(Problem):
 
     def __init__(self, model, model_case, lockdown_policy_control_days, lockdown_policy_lower_limits,
                  lockdown_policy_upper_limits, testing_policy_control_days, testing_policy_lower_limits,
-                 testing_policy_upper_limits, max_daily_tests, p_ICU, C_hos, T_rec):
+                 testing_policy_upper_limits, max_daily_tests, p_ICU, C_hos, T_rec, solver=None, cache=None,
+                 params_hash=None):
         self.model = model
         self.model_case = model_case
+        self.solver = solver # ParallelSolver used for evaluation, if None policies are solved in this process
+        self.cache = cache # EvaluationCache for F and G of evaluated individuals, None for no caching
+        self.params_hash = params_hash # identifies the run in the cache
         self.max_daily_tests_lim = max_daily_tests
         self.testing_policy_control_days = testing_policy_control_days
         self.lockdown_policy_control_days = lockdown_policy_control_days
@@ -87,59 +108,84 @@ class COVID_policy(Problem):
         )
 
     def _evaluate(self, x, out, *args, **kwargs):
-        f1 = []     # holds first objective
-        f2 = []     # holds second objective...
-        f3 = []
-
-        g1 = []     # holds first constraint
-
-        for j in range(len(x[:, 1])):  # evaluate f1 and f2 for each individual
 
-            # these slices contain indexing for decision variables representing lockdown and testing:
-            lockdown_var_slice = slice(0, self.n_var_ld + 1)
-            testing_var_slice = slice(self.n_var_ld,
-                                      self.n_var_ld + self.n_var_t + 1)
+        if self.cache is None:
+            out["F"], out["G"] = self._objectives(x)
+            return
+
+        # only individuals not found in the cache are simulated
+        keys = self.cache.keys(self.params_hash, x, self.xl, self.xu)
+        cached = [self.cache.get(key) for key in keys]
+        new = [i for i, values in enumerate(cached) if values is None]
+
+        F = np.zeros((len(x), self.n_obj))
+        G = np.zeros((len(x), self.n_constr))
+        if len(new) > 0:
+            F[new], G[new] = self._objectives(x[new])
+        for i, key in enumerate(keys):
+            if cached[i] is None:
+                self.cache.put(key, F[i], G[i])
+            else:
+                F[i], G[i] = cached[i]
+
+        out["F"] = F
+        out["G"] = G
+
+    def _objectives(self, x):
+        # returns objective (F) and constraint (G) values for the population x
+
+        # the whole population is simulated at once: row j of each output corresponds to individual j.
+        # lockdown and testing control days are handled by the solver, which splits x into decision variables
+        # representing lockdown (first n_var_ld columns) and testing (next n_var_t columns).
+        if self.solver is None:
+            Dead_D, Dead_T, Y_D, Y_total, tests = solve_objective_outputs(self.model, self.model_case, x,
+                                                                          self.lockdown_policy_control_days,
+                                                                          self.testing_policy_control_days)
+        else:
+            Dead_D, Dead_T, Y_D, Y_total, tests = self.solver.solve_objective_outputs(
+                x, self.lockdown_policy_control_days, self.testing_policy_control_days)
 
-            # create policies (dictionaries) for lockdown and testing
-            lockdown_policy = create_sub_policy(self.lockdown_policy_control_days, x[j, lockdown_var_slice])
-            testing_policy = create_sub_policy(self.testing_policy_control_days, x[j, testing_var_slice])
-            policy = Policy(lockdown_policy, testing_policy)
+        T_rec_t = int(round(14 * 365 * self.T_rec)) # change from years to time steps
 
-            Reported_D, Notinfected_D, Unreported_D, Infected_D, \
-            False_pos, False_neg, Recovered_D, Dead_D, Infected_T, Infected_not_Q, Infected_in_Q, Y_D, M_t, Y_total, total_testing_cost, tests, Unk_NA_nQ_D, Unk_NA_Q_D, K_NA_nQ_D, Unk_IA_nQ_D, Unk_IA_Q_D, K_IA_Q_D, alpha_D, ksi_TT_I_D, ksi_TT_N_D, ksi_TT_R_D, Symptomatic_D, Dead_T \
-                = self.model.solve_case(self.model_case, policy)
+        # scaling factor to normalize results (to correspond to only the simulation time)
+        scaling = self.model.T_years/(self.T_rec / 2 + self.model.T_years)
 
-            T_rec_t = int(round(14 * 365 * self.T_rec)) # change from years to time steps
+        #Costs:
+        cost_e = -Y_total / self.model.T # contains loss of output & scaled direct costs
+        cost_terminal = ((T_rec_t) / 2) * (-Y_D[:, -1]) / self.model.T
 
-            # scaling factor to normalize results (to correspond to only the simulation time)
-            scaling = self.model.T_years/(self.T_rec / 2 + self.model.T_years)
+        # Deaths are cumulative, so difference needed for current rate
+        # Scaling by / 1000 done to achieve similar scale with Costs
+        deaths_terminal = ((T_rec_t) / 2) * (((Dead_T[:, -1]-Dead_T[:, -2])) * self.model.pop / 1000) / self.model.T
 
-            #Costs:
-            cost_e = -Y_total / self.model.T # contains loss of output & scaled direct costs
-            cost_terminal = ((T_rec_t) / 2) * (-Y_D[-1]) / self.model.T
+        #print("cost_e: ", cost_e)
+        #print("cost_terminal: ", cost_terminal)
 
-            # Deaths are cumulative, so difference needed for current rate
-            # Scaling by / 1000 done to achieve similar scale with Costs
-            deaths_terminal = ((T_rec_t) / 2) * (((Dead_T[-1]-Dead_T[-2])) * self.model.pop / 1000) / self.model.T
+        # objectives scaled to roughly same scale
+        f1 = Dead_D[:, -1] * self.model.pop / 1000 + deaths_terminal     # holds first objective
+        f2 = scaling * (cost_e + cost_terminal)     # holds second objective...
 
-            #print("cost_e: ", cost_e)
-            #print("cost_terminal: ", cost_terminal)
+        max_daily_tests_value = np.max(tests, axis=1)
 
-            # objectives scaled to roughly same scale
-            f1.append(Dead_D[-1] * self.model.pop / 1000 + deaths_terminal)
-            f2.append(scaling * (cost_e + cost_terminal))
+        # constraints set in g(x) <= 0 format, normalized per coefficients
+        g1 = (max_daily_tests_value - self.max_daily_tests_lim)/self.max_daily_tests_lim     # holds first constraint
 
+        # Create objective and constraint vectors:
+        # NOTE: remember to set n_obj above!
+        F = np.column_stack([f1, f2])
+        # F = np.column_stack([f1, f2, f3])
+        G = np.column_stack([g1])
 
-            max_daily_tests_value = max(tests)
+        return F, G
 
-            g1_val = (max_daily_tests_value - self.max_daily_tests_lim)/self.max_daily_tests_lim
-            g1.append(g1_val)     # constraints set in g(x) <= 0 format, normalized per coefficients
+class CachedEvaluationDisplay(MultiObjectiveDisplay):
+    # verbose generation log with the (cumulative) hits and misses of the problem's evaluation cache
 
-        # Create objective and constraint vectors:
-        # NOTE: remember to set n_obj above!
-        out["F"] = np.column_stack([f1, f2])
-        # out["F"] = np.column_stack([f1, f2, f3])
-        out["G"] = np.column_stack([g1])
+    def _do(self, problem, evaluator, algorithm):
+        super()._do(problem, evaluator, algorithm)
+        if problem.cache is not None:
+            self.output.append("cache hits", problem.cache.hits, width=10)
+            self.output.append("cache miss", problem.cache.misses, width=10)
 
 
 
@@ -187,10 +233,16 @@ def create_optimization_run(
                 p_ICU=p_ICU_def,
                C_hos=C_hos_def,
                T_rec=T_rec_def, # recovery time in years from end of experiment
+               workers=1, # number of worker processes for evaluation
+               cache=None, # EvaluationCache shared by runs
+               prefix_nodes=0, # size of the prefix state trie of each epidemic model
                 **epidemic_model_params
                ):
 
-    model, model_case = create_epidemic_model(**epidemic_model_params)
+    model, model_case = create_epidemic_model(prefix_nodes=prefix_nodes, **epidemic_model_params)
+
+    # worker processes are started once per run and create their own copies of the epidemic model
+    solver = ParallelSolver(workers, dict(epidemic_model_params, prefix_nodes=prefix_nodes)) if workers > 1 else None
 
     #print("DEBUG policy parameters:")
     #print("ld days:", lockdown_policy_control_days)
@@ -202,7 +254,11 @@ def create_optimization_run(
 
     problem = COVID_policy(model, model_case, lockdown_policy_control_days, lockdown_policy_lower_limits,
                            lockdown_policy_upper_limits, testing_policy_control_days, testing_policy_lower_limits,
-                           testing_policy_upper_limits, max_daily_tests, p_ICU, C_hos, T_rec)
+                           testing_policy_upper_limits, max_daily_tests, p_ICU, C_hos, T_rec, solver, cache,
+                           run_parameters_hash(dict(epidemic_model_params,
+                                                    lockdown_policy_control_days=lockdown_policy_control_days,
+                                                    testing_policy_control_days=testing_policy_control_days,
+                                                    max_daily_tests=max_daily_tests, T_rec=T_rec)))
 
     # create initial population here
 
@@ -214,7 +270,8 @@ def create_optimization_run(
         sampling=initial_pop_x,
         crossover=crossover,
         mutation=mutation,
-        eliminate_duplicates=True
+        eliminate_duplicates=True,
+        display=CachedEvaluationDisplay()
     )
 
     return problem, algorithm, termination, model, model_case
@@ -226,7 +283,9 @@ def create_optimization_run(
 
 # loop through the different runs and
 for run in arg_runs:
-    problem, algorithm, termination, model, model_case = create_optimization_run(**runs[run])
+    problem, algorithm, termination, model, model_case = \
+        create_optimization_run(workers=args.workers, cache=evaluation_cache, prefix_nodes=args.prefix_nodes,
+                                **runs[run])
     epidemic_simulators[run] = (model, model_case)
     problems[run] = problem
 
@@ -239,6 +298,9 @@ for run in arg_runs:
                    save_history=False,  # True Needed for convergence analysis
                    verbose=True)
 
+    if problem.solver is not None:
+        problem.solver.close()
+
     # Which one to use? Pandas makes it easier to save column names...
     # np.savetxt('results/'+run+'_results.csv', res.X, delimiter=",")
     # np.savetxt('results/'+run+'_objectives.csv', res.F, delimiter=",")
@@ -264,6 +326,10 @@ for run in arg_runs:
 
     full_results = res_df.join(obj_df)
     full_results.to_csv('results/' + run + '_full_results' + file_suffix + '.csv', index=False)
+    # control types and days of the policy columns, read back without parsing the column names
+    save_policy_schema('results/' + run + '_full_results' + file_suffix + '.csv',
+                       PolicySchema([str(c) for c in df_column_names], [c[0] for c in df_column_names],
+                                    [c[1] for c in df_column_names]))
 
     constr_df = pd.DataFrame(data=res.G, columns=['Max daily tests marginal'])
     constr_df.to_csv('results/' + run + '_constraints' + file_suffix + '.csv', index=False)
@@ -1,11 +1,12 @@
 #!/bin/bash
 #SBATCH --time=60:00:00
-#SBATCH --mem-per-cpu=110M
+#SBATCH --mem-per-cpu=600M
 #SBATCH --array=0-49
 
 module restore covid_opt
 
 SAMPLE_SIZE=1000
+BATCH_SIZE=50 # samples simulated together, ~2.2 MB each at peak on top of ~160 MB for Python and libraries
 
 case $SLURM_ARRAY_TASK_ID in
 
@@ -63,4 +64,4 @@ case $SLURM_ARRAY_TASK_ID in
 
 esac
 
-srun python risk_analysis.py $SAMPLE_SIZE $RUN
+srun python risk_analysis.py $SAMPLE_SIZE $RUN --batch_size $BATCH_SIZE
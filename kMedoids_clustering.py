@@ -8,8 +8,8 @@ Created on Tue Nov 24 13:59:14 2020
 # %% IMPORTING NECESSARY PACKAGES 
 
 import numpy as np
-from scipy import stats
 import pandas as pd
+import time
 
 # %% DEFINING FUNCTIONS
 
@@ -19,57 +19,75 @@ import pandas as pd
 # saved in form ...
 #    - Calculate Pearson distance out of given correlation:
 #    d(x,y) = sqrt(0.5*(1-corr(x,y))) 
-def CalcPearson(data_in, nan_to_large_dist=False, grouping=None):
-    data = data_in.copy()
+#    Returns (corr, dist) as (num_pol, num_pol) arrays. Correlations are computed from the time points where both
+#    policies have values (pairs with less than 2 such points get NaN), as centred dot products of the normalised
+#    series. Policies are grouped by their NaN pattern, so that all pairs of two patterns share the same time points
+#    and are computed as one matrix product (in blocks of block_size rows).
+def CalcPearson(data_in, nan_to_large_dist=False, grouping=None, block_size=1024, dtype=np.float64):
+    data = np.asarray(data_in, dtype=np.float64)
+    return CalcPearsonCross(data, data, nan_to_large_dist, grouping, grouping, block_size, dtype)
 
+# Pearson correlations and distances between the policies (rows) of data_x and those of data_y, as in CalcPearson.
+# Returns (corr, dist) as (policies in data_x, policies in data_y) arrays.
+def CalcPearsonCross(data_x, data_y, nan_to_large_dist=False, grouping_x=None, grouping_y=None, block_size=1024,
+                     dtype=np.float64):
+    data_x = np.asarray(data_x, dtype=np.float64)
+    data_y = np.asarray(data_y, dtype=np.float64)
+    num_x, num_y = len(data_x), len(data_y)
 
-    corr = []
-    dist = []
-    [num_pol, n_t] = data.shape  # 1 time series per policy
-    #print("num_pol: ", num_pol)
-    
-    #going thorugh all cell combinations
-    for pol in range(0, num_pol):
-        X = data[pol, :]   # get timeseries of cell 1
-        corr_tmp = np.empty(num_pol)
-        corr_tmp.fill(np.nan)
-        dist_tmp = np.empty(num_pol)
-        dist_tmp.fill(np.nan)
-        for pol2 in range(0, num_pol):
-
-            Y = data[pol2, :]  # timeseries cell 2
-
-            # if grouping is used, and groups don't match -> large distance
-            if grouping is not None and grouping[pol] != grouping[pol2]:
-                print(grouping[pol])
-                print(grouping[pol2])
-                corr_tmp[pol2] = 0.0
-                dist_tmp[pol2] = 1.5  # max is 1, elsewhere checks if below 2 -> this should work
-
-            # checks whether there are nan values in X and Y that don't overlap
-            # ...which indicates a different policy class
-            # Returns a large (1.5) distance for different policy classes
-            # relevant usually only if grouping is not used
-            elif nan_to_large_dist and not(np.array_equal(np.isnan(X), np.isnan(Y))):
-                corr_tmp[pol2] = 0.0
-                dist_tmp[pol2] = 1.5 # max is 1, elsewhere checks if below 2 -> this should work
-            else:
-                use = np.logical_and(~np.isnan(X), ~np.isnan(Y)) # filters nan-containing data-pointsd
-                # from use
-                if np.sum(use) > 1: # if at least 2 points are available
-                                    # the distance is calculated
-                    corr_tmp[pol2] = stats.pearsonr(X[use], \
-                                                             Y[use])[0]
-                    dist_tmp[pol2] = np.sqrt(0.5*(1 - \
-                                                  corr_tmp[pol2]))
-                    #print("corr_tmp: ", corr_tmp)
-        corr.append(corr_tmp)
-        dist.append(dist_tmp)
-        #print("dist", dist)
-        #print("len dist: ", len(dist))
-        #print("dist 00: ", dist[0][0])
-
-    return corr, dist
+    corr = np.full((num_x, num_y), np.nan)
+
+    # policies with the same NaN pattern (same policy class) share the time points used in their correlations
+    available = np.concatenate([~np.isnan(data_x), ~np.isnan(data_y)])
+    patterns, pattern_of = np.unique(available, axis=0, return_inverse=True)
+    pattern_of = pattern_of.ravel()
+    pattern_x, pattern_y = pattern_of[:num_x], pattern_of[num_x:]
+
+    for a in range(len(patterns)):
+        rows_a = np.flatnonzero(pattern_x == a)
+        for b in range(len(patterns)):
+            rows_b = np.flatnonzero(pattern_y == b)
+            # different NaN patterns get a large distance below, if nan_to_large_dist is used
+            if (nan_to_large_dist and a != b) or len(rows_a) == 0 or len(rows_b) == 0:
+                continue
+            use = patterns[a] & patterns[b] # filters nan-containing data-points
+            if np.sum(use) <= 1: # at least 2 points are needed for the distance
+                continue
+            X_norm = _NormalisedRows(data_x[np.ix_(rows_a, use)])
+            Y_norm = _NormalisedRows(data_y[np.ix_(rows_b, use)])
+            for start in range(0, len(rows_a), block_size):
+                corr[np.ix_(rows_a[start:start + block_size], rows_b)] = \
+                    X_norm[start:start + block_size] @ Y_norm.T
+            if np.sum(use) == 2: # with 2 points the correlation is exactly 1 or -1 (unless a series is constant)
+                corr[np.ix_(rows_a, rows_b)] = np.sign(corr[np.ix_(rows_a, rows_b)])
+
+    corr = np.clip(corr, -1.0, 1.0)
+    dist = np.sqrt(0.5*(1 - corr))
+
+    # checks whether there are nan values in X and Y that don't overlap
+    # ...which indicates a different policy class
+    # Returns a large (1.5) distance for different policy classes
+    # relevant usually only if grouping is not used
+    if nan_to_large_dist:
+        different = pattern_x[:, None] != pattern_y[None, :]
+        corr[different] = 0.0
+        dist[different] = 1.5 # max is 1, elsewhere checks if below 2 -> this should work
+
+    # if grouping is used, and groups don't match -> large distance
+    if grouping_x is not None:
+        different = np.asarray(grouping_x)[:, None] != np.asarray(grouping_y)[None, :]
+        corr[different] = 0.0
+        dist[different] = 1.5  # max is 1, elsewhere checks if below 2 -> this should work
+
+    return corr.astype(dtype), dist.astype(dtype)
+
+# centred rows scaled to unit norm, as in scipy.stats.pearsonr. Constant rows get NaN values.
+def _NormalisedRows(X):
+    X_centred = X - X.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X_norm = X_centred / np.linalg.norm(X_centred, axis=1, keepdims=True)
+    X_norm[(X == X[:, :1]).all(axis=1)] = np.nan
+    return X_norm
 
 # --------------------------- k-Medoids Algorithm -----------------------------
 
@@ -89,6 +107,7 @@ def CalcPearson(data_in, nan_to_large_dist=False, grouping=None):
     
 # 0) Main part
 def kMedoids(k, dist, start_medoids = None):
+    dist = np.asarray(dist, dtype=np.float64)
     num_pol = len(dist)
     terminated = False
     step = 0
@@ -121,90 +140,209 @@ def kMedoids(k, dist, start_medoids = None):
     return(cluster, medoids, cost)
     
 # 1) Greedy algorithm for initial medoids
-def GetInitialMedoids(k, dist, num_pol):
+# Keeps the distance of each object to its nearest chosen medoid (2 before any are chosen), so that the cost of
+# adding each candidate is min(current distance, distance to candidate) squared and summed, computed for all
+# candidates at once (in blocks of block_size candidates).
+def GetInitialMedoids(k, dist, num_pol, block_size=None):
+    dist = np.asarray(dist, dtype=np.float64)
+    if block_size is None:
+        block_size = max(1, 4000000 // num_pol)
+    # distances of each object (columns) to each candidate (rows), NaN or >= 2 counting as 2, the candidate itself 0
+    cand_dist = np.ascontiguousarray(dist.T)
+    cand_dist[~(cand_dist < 2)] = 2.0
+    np.fill_diagonal(cand_dist, 0.0)
     medoids = []
+    cl_dist = np.full(num_pol, 2.0)
     # for each medoid take the cell the is the is the best choice at this point
-    # given the other mediods that are already chosen. 
+    # given the other mediods that are already chosen.
     for l in range(1, k+1):
-        best_cost = 0
-        # for each new medoid we check each possible cell 
-        for i in range(0, num_pol):
-
-            # temporarily add this cell to medoids
-            medoids_tmp = medoids.copy()
-            medoids_tmp.append(i)
-            # get new costs
-            cluster, cost = \
-                GetCluster(l, dist, num_pol, medoids_tmp)
-            # if best choice so far (or first cell checked) remember
-            if best_cost == 0:
-                best_cost = cost
-                best_medoid = i
-            elif cost < best_cost:
-                best_cost = cost
-                best_medoid = i
+        # costs of each possible cell as the new medoid
+        costs = np.empty(num_pol)
+        for start in range(0, num_pol, block_size):
+            costs[start:start + block_size] = \
+                np.sum(np.minimum(cand_dist[start:start + block_size], cl_dist[None, :])**2, axis=1)
+
+        # best choice: first cell with the smallest cost. A cost of 0 is not kept as the best choice but replaced
+        # by the next cell, as in checking the cells one by one starting from best_cost = 0.
+        if np.min(costs) > 0:
+            best_medoid = int(np.argmin(costs))
+        else:
+            best_cost = 0
+            for i in range(0, num_pol):
+                if best_cost == 0 or costs[i] < best_cost:
+                    best_cost = costs[i]
+                    best_medoid = i
         # add best choice to medoids
         medoids.append(best_medoid)
+        cl_dist = np.minimum(cl_dist, cand_dist[best_medoid])
     return(medoids)
 
 # 2) Subroutine to get clusters to given medoids:
+# Each object is assigned to the medoid with the smallest distance below 2 (first such medoid in case of ties). NaN
+# distances and distances of 2 or more count as 2, and an object with no medoid closer than 2 keeps the cluster of
+# the previous object assigned to a medoid. A medoid belongs to its own cluster at distance 0.
 def GetCluster(k, dist, num_pol, medoids):
-    cluster = np.empty([num_pol])
-    cluster.fill(np.nan)
-    cl_dist = np.empty([num_pol])
-    cl_dist.fill(np.nan)
-    # loop over all grid cells
-    for i in range(0, num_pol):
-
-        # we index cluster by the position of the respective medoid
-        # a medoid obviously belongs to its own cluster
-        if i in medoids:
-            cluster[i] = medoids.index(i)
-            cl_dist[i] = 0
-            continue
-        # initilizing the best distance with 2,  as 1 is the worst possible
-        # distance and we want something worse
-        best_dist = 2
-        # We check for each medoid how big the distance of the current grid
-        # cell to that medoid is. If we found a better distance than the
-        # current best_dist we update it and remember the medoid index
-
-        for k in medoids:
-            dist_tmp = dist[i][k]
-            if dist_tmp < best_dist:
-                best_dist = dist_tmp
-                best_med = medoids.index(k)
-
-        # we then save the best distance and the corresponding cluster
-
-        cluster[i] = best_med
-        cl_dist[i] = best_dist
+    cl_dist, nearest, second = _NearestMedoids(dist, medoids)
+    cluster = _ClusterLabels(cl_dist, nearest, medoids)
     # calculating the cost function: sum of all squared distances
     cost = np.nansum(cl_dist**2)
     return(cluster, cost)
-                
+
+# distances to the nearest and second nearest medoid (2 if there is none closer than 2) of each object, and the
+# position of the nearest medoid in medoids
+def _NearestMedoids(dist, medoids):
+    num_pol = len(dist)
+    med_dist = np.array(np.asarray(dist)[:, medoids], dtype=np.float64)
+    med_dist[~(med_dist < 2)] = 2.0
+    med_dist[medoids, np.arange(len(medoids))] = 0.0 # a medoid obviously belongs to its own cluster
+    nearest = np.argmin(med_dist, axis=1)
+    cl_dist = med_dist[np.arange(num_pol), nearest]
+    if len(medoids) > 1:
+        second = np.partition(med_dist, 1, axis=1)[:, 1]
+    else:
+        second = np.full(num_pol, 2.0)
+    return(cl_dist, nearest, second)
+
+# cluster (position of the medoid in medoids) of each object, see GetCluster
+def _ClusterLabels(cl_dist, nearest, medoids):
+    num_pol = len(cl_dist)
+    cluster = nearest.astype(np.float64)
+    is_medoid = np.zeros(num_pol, dtype=bool)
+    is_medoid[medoids] = True
+    assigned = (cl_dist < 2) & ~is_medoid
+    unassigned = ~(cl_dist < 2) & ~is_medoid
+    if unassigned.any():
+        # cluster of the previous object assigned to a medoid (the first medoid if there is none)
+        previous = np.maximum.accumulate(np.where(assigned, np.arange(num_pol), -1))
+        cluster[unassigned] = np.where(previous[unassigned] >= 0, nearest[np.maximum(previous[unassigned], 0)], 0)
+    # a medoid listed more than once belongs to the cluster of its first position
+    medoid_objects, first_positions = np.unique(medoids, return_index=True)
+    cluster[medoid_objects] = first_positions
+    return(cluster)
+
 # 3) Subroutine to get best change in medoids
-def GetSwitch(k, dist, num_pol, medoids):
-    new_cost = -1
-    # loop over all grid cells
-    for i in range(0, num_pol):
+# FastPAM-style: with the distances of each object to its nearest and second nearest medoid cached, the change in
+# cost of switching medoid j to object i is computed for all switches with array operations:
+#    delta(i, j) = sum over objects of min(d(o, i)^2 - d1(o)^2, 0)
+#                + sum over objects o of cluster j with d(o, i) >= d1(o) of min(d(o, i), d2(o))^2 - d1(o)^2
+# The switches with (nearly) the smallest change are then evaluated exactly with GetCluster, in the same order as
+# trying all switches one by one, so that the same switch is found.
+def GetSwitch(k, dist, num_pol, medoids, block_size=None):
+    dist = np.asarray(dist, dtype=np.float64)
+    cl_dist, nearest, second = _NearestMedoids(dist, medoids)
+    cost = np.nansum(cl_dist**2)
+    candidates = np.setdiff1d(np.arange(num_pol), medoids)
+    # if all objects are medoids there is no switch to make
+    if len(candidates) == 0:
+        return(_ClusterLabels(cl_dist, nearest, medoids), cost, medoids)
 
-        # if the grid cell already is a cluster a switch makes no sense
-        if i in medoids:
-            continue
-        # for each of the medoids we check what a switch would result in
-        for k in medoids:
-            # switching the medoids
-            medoids_tmp = medoids[:]
-            medoids_tmp[medoids_tmp.index(k)] = i
-            # getting the new cluster
-            cluster_tmp, cost_tmp = GetCluster(k, dist, num_pol, medoids_tmp)
-            # updating if we found a better switch (or if this was the
-            # first we tried)
-            if cost_tmp < new_cost or new_cost == -1:
-                new_cluster = cluster_tmp
-                new_cost = cost_tmp
-                new_medoids = medoids_tmp
-    # returning best switch found (even if it is no improvement to current 
+    in_cluster = (nearest[:, None] == np.arange(len(medoids))[None, :]).astype(np.float64)
+    if block_size is None:
+        block_size = max(1, 4000000 // num_pol)
+    delta = np.empty((len(medoids), len(candidates)))
+    for start in range(0, len(candidates), block_size):
+        block = candidates[start:start + block_size]
+        cand_dist = dist[:, block]
+        cand_dist = np.where(cand_dist < 2, cand_dist, 2.0)
+        cand_dist[block, np.arange(len(block))] = 0.0 # the new medoid itself
+        gain = np.minimum(cand_dist**2 - cl_dist[:, None]**2, 0.0).sum(axis=0)
+        loss = np.where(cand_dist >= cl_dist[:, None],
+                        np.minimum(cand_dist, second[:, None])**2 - cl_dist[:, None]**2, 0.0)
+        delta[:, start:start + block_size] = gain[None, :] + in_cluster.T @ loss
+
+    # switches within rounding error of the best one, in order of object and medoid position
+    tolerance = 1e-9 * (1 + num_pol)
+    near_best = np.argwhere((delta <= delta.min() + tolerance).T)
+
+    new_cost = -1
+    for c, j in near_best:
+        # switching the medoids
+        medoids_tmp = list(medoids[:])
+        medoids_tmp[j] = int(candidates[c])
+        # getting the new cluster
+        cluster_tmp, cost_tmp = GetCluster(k, dist, num_pol, medoids_tmp)
+        # updating if we found a better switch (or if this was the
+        # first we tried)
+        if cost_tmp < new_cost or new_cost == -1:
+            new_cluster = cluster_tmp
+            new_cost = cost_tmp
+            new_medoids = medoids_tmp
+    # returning best switch found (even if it is no improvement to current
     # situation - this is checked after)
     return(new_cluster, new_cost, new_medoids)
+
+# ------------------------ Sampling based k-Medoids (CLARA) -------------------
+
+# For large sets of policies the full distance matrix (num_pol x num_pol) is not formed. Instead k-Medoids is run on
+# n_samples random samples of sample_size policies (default 40 + 2k), each sample after the first including the best
+# medoids found so far. All policies are assigned to the medoids of each sample in blocks of block_size policies, and
+# the medoids with the lowest total cost over all policies are kept. Returns (cluster, medoids, cost) as kMedoids,
+# with cluster and cost over all policies. If report is True, time and the computed size of the largest distance
+# matrix formed (not measured memory use) are printed.
+def CLARA(k, data, n_samples=5, sample_size=None, nan_to_large_dist=False, grouping=None, seed=None,
+          block_size=1024, report=True):
+    start_time = time.time()
+    data = np.asarray(data, dtype=np.float64)
+    num_pol = len(data)
+    groups = None if grouping is None else np.asarray(grouping)
+    if sample_size is None:
+        sample_size = 40 + 2*k
+    sample_size = min(sample_size, num_pol)
+    rng = np.random.default_rng(seed)
+
+    best_medoids = None
+    for s in range(0, n_samples):
+        if best_medoids is None:
+            sample = rng.choice(num_pol, sample_size, replace=False)
+        else:
+            others = np.setdiff1d(np.arange(num_pol), best_medoids)
+            sample = np.concatenate([best_medoids, rng.choice(others, sample_size - len(best_medoids), replace=False)])
+        sample = np.sort(sample)
+
+        # clustering the sample
+        corr, dist = CalcPearson(data[sample], nan_to_large_dist, None if groups is None else groups[sample])
+        sample_cluster, sample_medoids, sample_cost = kMedoids(k, dist)
+        medoids = [int(sample[m]) for m in sample_medoids]
+
+        # assigning all policies to the sample medoids
+        cluster, cost = AssignClusters(data, medoids, nan_to_large_dist, grouping, block_size)
+        if best_medoids is None or cost < best_cost:
+            best_cluster, best_medoids, best_cost = cluster, medoids, cost
+
+        # with all policies in the sample, other samples would be the same
+        if sample_size == num_pol:
+            break
+
+    if report:
+        matrix_mb = max(sample_size**2, min(block_size, num_pol)*k) * 8 / 1e6
+        print("CLARA: %d policies, %d samples of %d, time %.2f s, distance matrix size: largest formed %.2f MB, "
+              "full matrix %.2f MB" % (num_pol, s + 1, sample_size, time.time() - start_time, matrix_mb,
+                                       num_pol**2 * 8 / 1e6))
+
+    return(best_cluster, best_medoids, best_cost)
+
+# Subroutine to get clusters of all policies to given medoids, as GetCluster, with the distances to the medoids
+# computed from the policy data in blocks of block_size policies
+def AssignClusters(data, medoids, nan_to_large_dist=False, grouping=None, block_size=1024):
+    data = np.asarray(data, dtype=np.float64)
+    num_pol = len(data)
+    groups = None if grouping is None else np.asarray(grouping)
+    medoid_groups = None if groups is None else groups[medoids]
+
+    cl_dist = np.empty(num_pol)
+    nearest = np.empty(num_pol, dtype=int)
+    for start in range(0, num_pol, block_size):
+        rows = np.arange(start, min(start + block_size, num_pol))
+        corr, med_dist = CalcPearsonCross(data[rows], data[medoids], nan_to_large_dist,
+                                          None if groups is None else groups[rows], medoid_groups)
+        med_dist[~(med_dist < 2)] = 2.0
+        for j, m in enumerate(medoids):
+            if start <= m < start + len(rows): # a medoid obviously belongs to its own cluster
+                med_dist[m - start, j] = 0.0
+        nearest[rows] = np.argmin(med_dist, axis=1)
+        cl_dist[rows] = med_dist[np.arange(len(rows)), nearest[rows]]
+
+    cluster = _ClusterLabels(cl_dist, nearest, medoids)
+    # calculating the cost function: sum of all squared distances
+    cost = np.nansum(cl_dist**2)
+    return(cluster, cost)
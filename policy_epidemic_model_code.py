@@ -1,6 +1,12 @@
 import numpy as np
 from math import isnan
 
+# numba is optional: if it is installed, the time step loop is run as compiled code (see solve_steps)
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 try:
     import plotly.graph_objs as go
     from plotly.subplots import make_subplots
@@ -13,6 +19,442 @@ except ImportError:
     from plotly.subplots import make_subplots
     from plotly.offline import init_notebook_mode, iplot
 
+def policy_arrays(sub_policy):
+    # splits a sub policy (dictionary with policy start days as keys, or "NA") into a list of control days
+    # and an array of corresponding policy values, the format used by the batched solver
+    if sub_policy == "NA":
+        return "NA", np.zeros(0)
+    else:
+        return list(sub_policy.keys()), np.array(list(sub_policy.values()), dtype=float)
+
+def schedule_values(time_steps, Delta_time, control_days, control_values, default):
+    # compiles piecewise constant policies into dense per time step values.
+    # control_days: policy start times (days), control_values: matching policy values, one row per policy
+    # returns an array with one row per policy and one column per time step. Each policy value applies from its
+    # start time until the next start time, default is used before the first one (and if control_days is "NA").
+    if control_days == "NA" or len(control_days) == 0:
+        return np.full((len(control_values), len(time_steps)), default, dtype=float)
+
+    order = np.argsort(control_days, kind='stable')
+    start_steps = np.asarray(control_days, dtype=float)[order] * Delta_time # unit of control days = days.
+
+    # index of the latest policy start time <= time step, -1 if there is none (-> default)
+    latest = np.searchsorted(start_steps, time_steps, side='right') - 1
+    values = np.column_stack([np.full(len(control_values), default, dtype=float), control_values[:, order]])
+
+    return values[:, latest + 1]
+
+class PolicySchedule():
+    # policies compiled to dense per time step values for one model and model case, see
+    # optimizable_corona_model.compile_policies. Row n of lockdown_eff and tau holds lockdown strength and testing rate
+    # of policy n at each time step. The other rates depend only on the model case and are shared by all policies.
+    # control_steps: time steps where policy values can change (policy start times), used as checkpoints for
+    # resuming policies from a PrefixStateTrie
+    def __init__(self, lockdown_eff, tau, tau_TT, test_sens, test_spec, r_U, r_R, control_steps=()):
+        self.lockdown_eff = lockdown_eff
+        self.tau = tau
+        self.tau_TT = tau_TT
+        self.test_sens = test_sens
+        self.test_spec = test_spec
+        self.r_U = r_U
+        self.r_R = r_R
+        self.control_steps = control_steps
+
+    def __len__(self):
+        return len(self.lockdown_eff)
+
+class SimulationResult():
+    # Outputs of solved policies (or parameter samples), one row each. Per time step values are kept in one contiguous
+    # array, data, of shape (rows, 18, T): compartment masses M_t (12 rows), alpha, ksi_TT_I, ksi_TT_N, ksi_TT_R, tests
+    # and productivity Y_t. Outputs are derived from it only when first asked for, either by name (result.Dead_D) or by
+    # index (result[7]) following visualization.output_names. Iterating gives all outputs in index order, as in the
+    # output tuple of earlier versions. A single row result (see row, solve_case) has no row axis.
+
+    fields = ['Reported_D', 'Notinfected_D', 'Unreported_D', 'Infected_D', 'False_pos', 'False_neg', 'Recovered_D',
+              'Dead_D', 'Infected_T', 'Infected_not_Q', 'Infected_in_Q', 'Y_D', 'M_t', 'Y_total', 'total_cost',
+              'tests', 'Unk_NA_nQ_D', 'Unk_NA_Q_D', 'K_NA_nQ_D', 'Unk_IA_nQ_D', 'Unk_IA_Q_D', 'K_IA_Q_D', 'alpha_D',
+              'ksi_TT_I_D', 'ksi_TT_N_D', 'ksi_TT_R_D', 'Symptomatic_D', 'Dead_T']
+
+    # outputs that are end of day values of a sum of compartments
+    compartment_sums = {'Notinfected_D': [0, 1, 2], 'Unreported_D': [3, 4], 'False_pos': [6], 'False_neg': [7],
+                        'Recovered_D': [9, 10], 'Infected_not_Q': [3, 7], # includes false negatives
+                        'Infected_in_Q': [4, 5, 8], # includes all infected in quarantine including false negs
+                        'Symptomatic_D': [8]}
+    # outputs that are end of day values of a row of data
+    daily_rows = {'Unk_NA_nQ_D': 0, 'Unk_NA_Q_D': 1, 'K_NA_nQ_D': 2, 'Unk_IA_nQ_D': 3, 'Unk_IA_Q_D': 4, 'K_IA_Q_D': 5,
+                  'Dead_D': 11, 'alpha_D': 12, 'ksi_TT_I_D': 13, 'ksi_TT_N_D': 14, 'ksi_TT_R_D': 15, 'Y_D': 17}
+
+    def __init__(self, data, tau, tau_TT, test_sens, test_spec, delta, pop, test_cost):
+        self.data = data
+        # rates of the last time step used for reported cases, tau and delta have one value per row
+        self.tau = tau
+        self.tau_TT = tau_TT
+        self.test_sens = test_sens
+        self.test_spec = test_spec
+        self.delta = delta
+        self.pop = pop
+        self.test_cost = test_cost
+        self.outputs = {} # outputs derived so far
+
+    def row(self, n):
+        # result of row n only
+        return SimulationResult(self.data[n], self.tau[n], self.tau_TT, self.test_sens, self.test_spec,
+                                self.delta[n], self.pop, self.test_cost)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.fields)))
+
+    def __getitem__(self, key):
+        name = key if isinstance(key, str) else self.fields[key]
+        if name not in self.outputs:
+            self.outputs[name] = self._derive(name)
+        return self.outputs[name]
+
+    def __getattr__(self, name):
+        if name in SimulationResult.fields:
+            return self[name]
+        raise AttributeError(name)
+
+    def _derive(self, name):
+        M_t = self.data[..., :12, :]
+        tests = self.data[..., 16, :]
+        daily = slice(13, None, 14) # Note: 13::14 refers to time indices, i.e. 'end of day for all days'
+
+        if name in self.compartment_sums:
+            return np.sum(M_t[..., self.compartment_sums[name], daily], axis=-2)
+        elif name in self.daily_rows:
+            return self.data[..., self.daily_rows[name], daily]
+        elif name == 'M_t':
+            return M_t
+        elif name == 'Dead_T':
+            return M_t[..., 11, :]
+        elif name == 'Infected_T':
+            return np.sum(M_t[..., [3, 4, 5], :], axis=-2) + np.sum(M_t[..., [7, 8], :], axis=-2)
+        elif name == 'Infected_D':
+            return self['Infected_T'][..., daily]
+        elif name == 'Y_total':
+            return np.sum(self.data[..., 17, :], axis=-1)
+        elif name == 'total_cost':
+            return np.sum(tests, axis=-1)*self.test_cost
+        elif name == 'tests':
+            return np.sum(tests.reshape(tests.shape[:-1] + (-1, 14)), axis=-1) # sums up total daily testing numbers
+        elif name == 'Reported_D':
+            # reported calculated from tested cases
+            tau_t = np.asarray(self.tau)[..., np.newaxis]
+            tau_TT = self.tau_TT
+            test_sens = self.test_sens
+            test_spec = self.test_spec
+            delta = np.asarray(self.delta)[..., np.newaxis]
+            Reported_T_start = self.pop * ((test_sens * tau_t + delta) * M_t[..., 3, :] + (test_sens * tau_TT + delta) * M_t[..., 4, :] + test_spec * tau_t * M_t[..., 0, :] + test_spec * (tau_t + tau_TT) * M_t[..., 1, :])
+            Reported_T_start[..., 0] = 0
+            return np.cumsum(Reported_T_start, axis=-1)[..., daily]
+
+class PrefixStateTrie():
+    # Simulated history (compartment masses and other per time step values) of solved policies, stored in a trie.
+    # Each level of the trie corresponds to the time steps between two consecutive checkpoints (control steps of the
+    # schedule) and is keyed by the policy values on those steps. A policy sharing its values up to a checkpoint with
+    # an already solved policy is resumed at the checkpoint from the stored history instead of solved from the start.
+    # The trie holds the histories for one set of checkpoints and shared model case rates at a time: it is cleared
+    # when these change, or when it would grow over max_nodes nodes.
+
+    def __init__(self, max_nodes):
+        self.max_nodes = max_nodes
+        self.clear(None)
+
+    def clear(self, context):
+        self.context = context
+        self.root = {} # key: policy values between checkpoints, value: [stored history, child nodes]
+        self.n_nodes = 0
+
+    def _segments(self, schedule):
+        # (start, end, key function) for each level of the trie, updates the trie context for the schedule
+        steps = [0] + [step for step in schedule.control_steps if 0 < step < schedule.lockdown_eff.shape[1]]
+        context = (tuple(steps), b''.join(np.asarray(rates, dtype=float).tobytes() for rates in
+                                          (schedule.tau_TT, schedule.test_sens, schedule.test_spec, schedule.r_U,
+                                           schedule.r_R)))
+        if context != self.context:
+            self.clear(context)
+
+        return list(zip(steps[:-1], steps[1:]))
+
+    def restore(self, schedule, histories):
+        # copies the stored history of each policy in the schedule, as far as it is found, to histories (arrays with
+        # one row per policy and time on the last axis). Returns the time step to resume each policy from.
+        start = np.ones(len(schedule), dtype=np.int64)
+        segments = self._segments(schedule)
+
+        for n in range(len(schedule)):
+            nodes = self.root
+            for a, b in segments:
+                key = schedule.lockdown_eff[n, a:b].tobytes() + schedule.tau[n, a:b].tobytes()
+                if key not in nodes:
+                    break
+                stored, nodes = nodes[key]
+                for history, values in zip(histories, stored):
+                    history[n, ..., a:b] = values
+                start[n] = b
+
+        return start
+
+    def store(self, schedule, histories):
+        # adds the histories of the solved policies in the schedule to the trie
+        segments = self._segments(schedule)
+
+        for n in range(len(schedule)):
+            nodes = self.root
+            for a, b in segments:
+                key = schedule.lockdown_eff[n, a:b].tobytes() + schedule.tau[n, a:b].tobytes()
+                if key not in nodes:
+                    if self.n_nodes >= self.max_nodes:
+                        self.clear(self.context)
+                        break
+                    nodes[key] = [[history[n, ..., a:b].copy() for history in histories], {}]
+                    self.n_nodes += 1
+                nodes = nodes[key][1]
+
+class TransitionKernel():
+    # Transitions between the 12 compartments of the model for N rows (policies or samples) solved together.
+    # The edges, i.e. the possible transitions, are fixed. Rates of edges leaving symptomatic, recovered and false
+    # positive/negative compartments are constant and set once here, only the time-varying rates are updated on each
+    # time step. Flows are applied directly to the compartment masses instead of through a 12x12 transition matrix.
+    #
+    # compartments: 0 unknown not infected asymptomatic (NA), not quarantined (NQ), 1 unknown NA, Q, 2 known NA, NQ,
+    # 3 unknown infected asymptomatic (IA), NQ, 4 unknown IA, Q, 5 known IA, Q, 6 false positive, Q,
+    # 7 false negative, NQ, 8 infected symptomatic, Q, 9 recovered, NQ, 10 recovered, Q, 11 dead
+
+    # (from, to) for all edges, ordered by the compartment left. Dead (11) is the only one with no edges leaving.
+    edges = [(0, 1), (0, 2), (0, 3), (0, 6),
+             (1, 0), (1, 2), (1, 4), (1, 6),
+             (2, 0), (2, 3),
+             (3, 4), (3, 5), (3, 7), (3, 8), (3, 9),
+             (4, 3), (4, 5), (4, 7), (4, 8), (4, 10),
+             (5, 8), (5, 10),
+             (6, 0), (6, 5),
+             (7, 8), (7, 9),
+             (8, 10), (8, 11),
+             (9, 0), (9, 10),
+             (10, 9)]
+
+    def __init__(self, model, N):
+        self.lambda_param = model.lambda_param
+        self.lambda_paramQ = model.lambda_paramQ
+
+        self.index = {edge: i for i, edge in enumerate(self.edges)}
+        source, target = np.array(self.edges).T
+        self.source = source
+        self.source_starts = np.searchsorted(source, np.arange(11)) # first edge leaving each of compartments 0-10
+        self.by_target = np.argsort(target, kind='stable')
+        self.target_starts = np.searchsorted(target[self.by_target], np.arange(12))
+
+        # rates for all edges, one row per policy / sample. Constant rates (scalars or per sample) are set here.
+        self.rates = np.zeros((N, len(self.edges)))
+        constant_rates = {
+            (2, 0): model.sigma,   # knowledge degradation
+            (3, 8): model.delta,   # symptom development
+            (3, 9): model.omegaR,  # recovery
+            (4, 8): model.delta,
+            (4, 10): model.omegaR,
+            (5, 8): model.delta,
+            (5, 10): model.omegaR,
+            (6, 0): model.omegaR,  # false positive released from quarantine
+            (7, 8): model.delta,   # false negative, infection diagnosed correctly when symptoms develop
+            (7, 9): model.omegaR,
+            (8, 10): model.omegaR,
+            (8, 11): model.omegaD, # death
+            (9, 0): model.gamma    # immunity loss
+        }
+        for edge, rate in constant_rates.items():
+            self.rates[:, self.index[edge]] = rate
+
+    def set_rates(self, lockdown_eff, tau, tau_TT, test_sens, test_spec, r_U, r_R, alphat, ksi_TT_I, ksi_TT_N, ksi_TT_R):
+        # updates the time-varying rates for the current time step, for the first len(alphat) rows
+        rates = self.rates[:len(alphat)]
+        index = self.index
+
+        infection_NQ = lockdown_eff * self.lambda_param * alphat
+        infection_Q = self.lambda_paramQ * alphat
+
+        # from not known NA, NQ - Not infected Asymptomatic, Not Quarantined
+        rates[:, index[0, 1]] = ksi_TT_N  # To NA, Quarantined, based on test & trace
+        rates[:, index[0, 2]] = tau * test_spec  # To known not-infected asymptomatic, NQ
+        rates[:, index[0, 3]] = infection_NQ  # To unknown infected asympt., not NQ
+        rates[:, index[0, 6]] = tau * (1.0 - test_spec)  # to false positive, NQ
+
+        # from not known NA, Q - Not infected Asymptomatic, Quarantined
+        rates[:, index[1, 0]] = r_U
+        rates[:, index[1, 2]] = (tau + tau_TT) * test_spec  # To known not-infected asymptomatic, Quarantined
+        rates[:, index[1, 4]] = infection_Q
+        rates[:, index[1, 6]] = (tau + tau_TT) * (1.0 - test_spec)  # To false positive, Quarantined
+
+        # from known NA, NQ - Not infected Asymptomatic, Not Quarantined
+        rates[:, index[2, 3]] = infection_NQ  # To unknown infected asymptomatic, not NQ
+
+        # from not known IA, NQ - Infected Asymptomatic, Not Quarantined
+        rates[:, index[3, 4]] = ksi_TT_I
+        rates[:, index[3, 5]] = tau * test_sens  # To known infected asymptomatic, Q
+        rates[:, index[3, 7]] = tau * (1.0 - test_sens)  # To false negative, NQ
+
+        # from not known IA, Q - Infected Asymptomatic, Quarantined
+        rates[:, index[4, 3]] = r_U
+        rates[:, index[4, 5]] = tau_TT * test_sens  # To known infected asymptomatic, Quarantined
+        rates[:, index[4, 7]] = tau_TT * (1.0 - test_sens)  # to false negative, Quarantined
+
+        # from false Positive, Quarantined: actually gets infected, 'infection while in Q rate'
+        rates[:, index[6, 5]] = infection_Q
+
+        # from Recovered Asymptomatic, Not Quarantined / Quarantined
+        rates[:, index[9, 10]] = ksi_TT_R
+        rates[:, index[10, 9]] = r_R
+
+    def apply(self, Mt, M_next):
+        # calculates compartment masses M_next (rows x 12) from masses Mt on the previous time step
+        rates = self.rates[:len(Mt)]
+
+        # probabilities for staying in same compartment
+        stay = 1 - np.add.reduceat(rates, self.source_starts, axis=1)
+
+        # This tests that there are no clearly faulty values, i.e. all transition probabilities are in [0, 1]
+        assert rates.min() >= 0 and stay.min() >= 0, rates
+
+        flows = Mt[:, self.source] * rates
+        M_next[:, :11] = stay * Mt[:, :11]
+        M_next[:, 11] = Mt[:, 11]
+        M_next += np.add.reduceat(flows[:, self.by_target], self.target_starts, axis=1)
+
+def solve_steps(start, M_t, tests, alpha_T, ksi_TT_I_T, ksi_TT_N_T, ksi_TT_R_T, Y_t, lockdown_eff_T, tau_T,
+                tau_TT_T, test_sens_T, test_spec_T, r_U_T, r_R_T, lambda_param, lambda_paramQ, rhoS, rhoA, delta,
+                omegaR, omegaD, gamma, sigma, eta, pop, A_rel):
+    # The time step loop of optimizable_corona_model._solve_batch written out for one row (policy / sample) and
+    # compartment at a time. Compiled with numba when it is available, the outputs are then the same as from the
+    # NumPy loop up to rounding. All arguments are arrays: row n is solved from time step start[n] on. tests (N, T)
+    # is filled in place, as are M_t (N, 12, H), alpha_T and ksi_TT_*_T (N, H), which hold time step t in column
+    # t % H: H = T for full histories, 4 for only the steps needed by the update. Y_t (N, T) is filled with
+    # productivity if it has columns (lean mode). lockdown_eff_T and tau_T are (T, N), the other schedule values (T,)
+    # and model constants (N,).
+    N, n_comp, H = M_t.shape
+    T = tests.shape[1]
+    for n in range(N):
+        lambda_n = lambda_param[n]
+        lambda_Q = lambda_paramQ[n]
+        for t in range(start[n], T):
+            lockdown_eff = lockdown_eff_T[t, n]
+            tau_t = tau_T[t, n]
+            tau_TT = tau_TT_T[t]
+            test_sens = test_sens_T[t]
+            test_spec = test_spec_T[t]
+
+            Mt = M_t[n, :, (t - 1) % H]
+            Mt_tm1 = M_t[n, :, (t - 2) % H] # lags before the start wrap around to the (still empty) last columns
+            Mt_tm2 = M_t[n, :, (t - 3) % H]
+
+            Mt_Q = Mt[1] + Mt[4] + Mt[5] + Mt[6] + Mt[8] + Mt[10]
+            Mt_NQ = Mt[0] + Mt[2] + Mt[3] + Mt[7] + Mt[9]
+            Mt_IANQ = Mt[3]
+            Mt_IAQ = Mt[4] + Mt[5]
+            Mt_ISQ = Mt[8]
+            Mt_FNNQ = Mt[7]
+            Mt_NANQ = Mt[0] + Mt[2]
+            Mt_RANQ = Mt[9]
+
+            Mt_Total = lockdown_eff*lambda_n * Mt_NQ + lambda_Q * Mt_Q
+            Mt_I = lockdown_eff*lambda_n * (Mt_IANQ + Mt_FNNQ) + lambda_Q * (Mt_IAQ + Mt_ISQ)
+
+            pit_I = Mt_I / Mt_Total
+            pit_IA = (lockdown_eff*lambda_n * Mt_IANQ + lambda_Q * Mt_IAQ + lockdown_eff*lambda_n * Mt_FNNQ) / Mt_I
+            pit_IS = (lambda_Q * Mt_ISQ) / Mt_I
+
+            alphat = pit_I * (pit_IS * rhoS[n] + pit_IA * rhoA[n])
+            alpha_T[n, t % H] = alphat
+
+            # test and trace rates
+            Mtm1_NANQ = Mt_tm1[0] + Mt_tm1[2]
+            Mtm1_RNQ = Mt_tm1[9]
+            Mtm2_IAQ = Mt_tm2[4] + Mt_tm2[5]
+            Mtm2_IANQ = Mt_tm2[3]
+
+            pit_ISTm1 = delta[n]*(lambda_Q * Mtm2_IAQ + lockdown_eff* lambda_n * Mtm2_IANQ) / Mt_Total
+            pit_IATm1 = (lockdown_eff * lambda_n * Mtm2_IANQ * tau_t + lambda_Q * Mtm2_IAQ * (tau_TT + tau_t) ) * test_sens / Mt_Total
+            pit_FPm1 = (lockdown_eff * lambda_n * Mtm2_IANQ * tau_t + lambda_Q * Mtm2_IAQ * (tau_TT + tau_t) ) * (1-test_sens) / Mt_Total
+
+            M_TI_t = lockdown_eff * lambda_n * (pit_ISTm1 * rhoS[n] + pit_IATm1 * rhoA[n]) * Mtm1_NANQ
+            M_TN_t = lockdown_eff * lambda_n * (pit_ISTm1 * (1-rhoS[n]) + pit_IATm1 * (1-rhoA[n]) + pit_FPm1) * Mtm1_NANQ
+            M_TR_t = lockdown_eff * lambda_n * (pit_ISTm1 + pit_IATm1 + pit_FPm1) * Mtm1_RNQ
+
+            ksi_TT_I = eta[n] * M_TI_t / Mt_IANQ
+            ksi_TT_N = eta[n] * M_TN_t / Mt_NANQ
+            ksi_TT_R = eta[n] * M_TR_t / Mt_RANQ
+            if isnan(ksi_TT_R):
+                ksi_TT_R = 0.
+
+            ksi_TT_I_T[n, t % H] = ksi_TT_I
+            ksi_TT_N_T[n, t % H] = ksi_TT_N
+            ksi_TT_R_T[n, t % H] = ksi_TT_R
+
+            # rates along the edges of TransitionKernel, grouped by the compartment left
+            infection_NQ = lockdown_eff * lambda_n * alphat
+            infection_Q = lambda_Q * alphat
+            r_U = r_U_T[t]
+            r_R = r_R_T[t]
+
+            r_0 = (ksi_TT_N, tau_t * test_spec, infection_NQ, tau_t * (1.0 - test_spec))
+            r_1 = (r_U, (tau_t + tau_TT) * test_spec, infection_Q, (tau_t + tau_TT) * (1.0 - test_spec))
+            r_2 = (sigma[n], infection_NQ)
+            r_3 = (ksi_TT_I, tau_t * test_sens, tau_t * (1.0 - test_sens), delta[n], omegaR[n])
+            r_4 = (r_U, tau_TT * test_sens, tau_TT * (1.0 - test_sens), delta[n], omegaR[n])
+            r_5 = (delta[n], omegaR[n])
+            r_6 = (omegaR[n], infection_Q)
+            r_7 = (delta[n], omegaR[n])
+            r_8 = (omegaR[n], omegaD[n])
+            r_9 = (gamma[n], ksi_TT_R)
+            r_10 = r_R
+
+            stay_0 = 1 - (r_0[0] + r_0[1] + r_0[2] + r_0[3])
+            stay_1 = 1 - (r_1[0] + r_1[1] + r_1[2] + r_1[3])
+            stay_2 = 1 - (r_2[0] + r_2[1])
+            stay_3 = 1 - (r_3[0] + r_3[1] + r_3[2] + r_3[3] + r_3[4])
+            stay_4 = 1 - (r_4[0] + r_4[1] + r_4[2] + r_4[3] + r_4[4])
+            stay_5 = 1 - (r_5[0] + r_5[1])
+            stay_6 = 1 - (r_6[0] + r_6[1])
+            stay_7 = 1 - (r_7[0] + r_7[1])
+            stay_8 = 1 - (r_8[0] + r_8[1])
+            stay_9 = 1 - (r_9[0] + r_9[1])
+            stay_10 = 1 - r_10
+
+            # This tests that there are no clearly faulty values, i.e. all transition probabilities are in [0, 1]
+            assert min(min(r_0), min(r_1), min(r_2), min(r_3), min(r_4), min(r_5), min(r_6), min(r_7), min(r_8),
+                       min(r_9), r_10) >= 0, \
+                "negative transition rate"
+            assert min(stay_0, stay_1, stay_2, stay_3, stay_4, stay_5, stay_6, stay_7, stay_8, stay_9,
+                       stay_10) >= 0, "transition probabilities over 1"
+
+            M_next = M_t[n, :, t % H]
+            M_next[0] = stay_0*Mt[0] + r_1[0]*Mt[1] + r_2[0]*Mt[2] + r_6[0]*Mt[6] + r_9[0]*Mt[9]
+            M_next[1] = stay_1*Mt[1] + r_0[0]*Mt[0]
+            M_next[2] = stay_2*Mt[2] + r_0[1]*Mt[0] + r_1[1]*Mt[1]
+            M_next[3] = stay_3*Mt[3] + r_0[2]*Mt[0] + r_2[1]*Mt[2] + r_4[0]*Mt[4]
+            M_next[4] = stay_4*Mt[4] + r_1[2]*Mt[1] + r_3[0]*Mt[3]
+            M_next[5] = stay_5*Mt[5] + r_3[1]*Mt[3] + r_4[1]*Mt[4] + r_6[1]*Mt[6]
+            M_next[6] = stay_6*Mt[6] + r_0[3]*Mt[0] + r_1[3]*Mt[1]
+            M_next[7] = stay_7*Mt[7] + r_3[2]*Mt[3] + r_4[2]*Mt[4]
+            M_next[8] = stay_8*Mt[8] + r_3[3]*Mt[3] + r_4[3]*Mt[4] + r_5[0]*Mt[5] + r_7[0]*Mt[7]
+            M_next[9] = stay_9*Mt[9] + r_3[4]*Mt[3] + r_7[1]*Mt[7] + r_10*Mt[10]
+            M_next[10] = stay_10*Mt[10] + r_4[4]*Mt[4] + r_5[1]*Mt[5] + r_8[0]*Mt[8] + r_9[1]*Mt[9]
+            M_next[11] = Mt[11] + r_8[1]*Mt[8]
+
+            Mt_test = Mt[0] + Mt[1] + Mt[3] + Mt[4]
+            Mt_TT_test = Mt[1] + Mt[4]
+            tests[n, t] = (Mt_test*tau_t + Mt_TT_test*tau_TT)*pop
+
+            if Y_t.shape[1] > 0:
+                Y_t[n, t] = lockdown_eff * (M_next[0] + M_next[2] + M_next[3] + M_next[7] + M_next[9]) + \
+                            A_rel * (M_next[1] + M_next[4] + M_next[5] + M_next[6] + M_next[10])
+
+# compiled version of solve_steps, None if numba is not installed. Division by zero follows NumPy (nan / inf).
+solve_steps_jit = None if njit is None else njit(cache=True, error_model='numpy')(solve_steps)
+
 class optimizable_corona_model(object):
     # ksi_base: baseline quarantine rate
     # A_rel: relative productivity of quarantined
@@ -46,6 +488,11 @@ class optimizable_corona_model(object):
         self.rhoA         = rel_rho*self.rhoS
 
         self.InitialInfect = initial_infect
+
+        # R_0, pii_D, delta_param, gamma_param and initial_infect can also be given as arrays with one value per
+        # sample. The model is then sample-batched: solve_case_samples simulates all samples together.
+        self.n_samples = np.broadcast(R_0, pii_D, delta_param, gamma_param, initial_infect).size
+
         self.d_vaccine     = d_vaccine
         self.A_rel         = A_rel
         self.ksi_base        = ksi_base
@@ -91,343 +538,314 @@ class optimizable_corona_model(object):
 
         self.policy_offset = 14
 
+        # the time step loop is run as compiled code if numba is installed, set to False to use the NumPy loop
+        self.use_jit = solve_steps_jit is not None
+
+        # PrefixStateTrie for resuming policies from histories of earlier solved policies, see set_prefix_reuse
+        self.prefix_trie = None
+
+
+    def set_prefix_reuse(self, max_nodes):
+        # stores histories of solved policies in a PrefixStateTrie of at most max_nodes nodes (0: no reuse). Policies
+        # sharing their values up to a control day with an earlier solved policy are then resumed from that day.
+        # Outputs are the same as without reuse with the compiled time step loop (use_jit), and the same within
+        # floating point tolerance with the NumPy loop. Each node holds the history of one policy between two control
+        # days, so memory use is roughly (max_nodes / number of control days) times the 1.5 MB history of a policy
+        # (18 x T float64 values, T = 10220 time steps).
+        self.prefix_trie = PrefixStateTrie(max_nodes) if max_nodes > 0 else None
 
     def solve_case(self, model, policy):
+        # solves a single policy: the policy is run through the batched solver as a batch of one and the
+        # SimulationResult of its row is returned.
+        # policy can be a Policy or a PolicySchedule compiled for this model and model case (see compile_policy)
+        assert self.n_samples == 1, "sample-batched model, use solve_case_samples"
 
-        lockdown_policy = policy.lockdown_policy
-        testing_policy = policy.testing_policy
-        # debugging prints:
-        #print("Solving model: ", model)
-        #print("Lockdownpolicy: ", lockdown_policy)
-        #print("Other params: ", self.__dict__)
+        return self.solve_case_samples(model, policy).row(0)
 
-        M0_vec = np.zeros(12)
-        M0_vec[3] = self.InitialInfect / self.pop  # initial infected, asymptomatic, not quarantined, and unknown cases
-        M0_vec[8] = 2. / self.pop  # initial infected, symptomatic, quarantined (and known) cases
-        M0_vec[0] = 1 - np.sum(M0_vec)
+    def solve_case_samples(self, model, policy):
+        # solves a single policy for every parameter sample of a sample-batched model (see __init__).
+        # Returns a SimulationResult with one row per sample.
 
-        Q_inds = [1, 4, 5, 6, 8, 10]
-        NQ_inds = [0, 2, 3, 7, 9]
-        IANQ_inds = [3] # doesn't include false negatives!
-        IAQ_inds = [4, 5]
-        ISQ_inds = [8]
-        NANQ_inds = [0, 2]
-        RANQ_inds = [9]
-        NAQ_inds = [1]
-        RAQ_inds = [10]
+        return self._solve_batch(model, self.compile_policy(model, policy))
 
-        FP_inds = [6]
-        FPQ_inds = [6]
-        FN_inds = [7]
-        FNNQ_inds = [7]
+    def solve_case_batch(self, model, X, lockdown_policy_control_days=None, testing_policy_control_days=None):
+        # solves N policies at once. X is an (N, n_var) decision matrix in the optimizer's format: lockdown values for
+        # lockdown_policy_control_days first, then testing values for testing_policy_control_days. Either control
+        # day list can be "NA" (or empty), in which case the corresponding default policy is used.
+        # X can also be a PolicySchedule holding N policies, the control days are not needed then.
+        # Returns a SimulationResult with one row per policy.
 
-        test_inds = [0, 1, 3, 4]
-        TT_test_inds = [1, 4]
+        if not isinstance(X, PolicySchedule):
+            X = self.compile_decisions(model, X, lockdown_policy_control_days, testing_policy_control_days)
 
-        # Members in each state on different time steps?
-        M_t = np.zeros((12, self.T))
-        alpha_T = np.zeros((self.T)) # alpha values will be saved in this one
-        ksi_TT_I_T = np.zeros((self.T)) # test and trace Q rate will be saved here
-        ksi_TT_N_T = np.zeros((self.T))
-        ksi_TT_R_T = np.zeros((self.T))
-        M_t[:, 0] = M0_vec
-        lockdown_effs = np.zeros((self.T))
-        tests = np.zeros((self.T))
+        return self._solve_batch(model, X)
 
-        def policy_timer(time, policy, default="NA"):
-            # policy: dictionary with policy start times as keys
-            # time: moment of time at hand
-            # returns correct policy parameter value for time
+    def solve_objectives_batch(self, model, X, lockdown_policy_control_days=None, testing_policy_control_days=None):
+        # lean version of solve_case_batch for optimization: returns only Dead_D, Dead_T, Y_D, Y_total and tests_D,
+        # without keeping the full compartment history. Dead_D and Y_D hold only the last day, Dead_T the last two
+        # time steps. Values are the same as the corresponding solve_case_batch outputs.
 
-            #debug:
-            #print("policy in timer: ", policy)
-            if policy == "NA":
-                return default
-            else:
-                filt_keys = []
-                for k in list(policy.keys()):
-                    if k * self.Delta_time <= time: # unit of k = days.
+        if not isinstance(X, PolicySchedule):
+            X = self.compile_decisions(model, X, lockdown_policy_control_days, testing_policy_control_days)
 
-                        filt_keys.append(k)
-                try:
-                    t_key = np.max(filt_keys) # finds the largest key of those <= to time
-                    param = policy[t_key]
+        return self._solve_batch(model, X, lean=True)
 
-                    return param
-                except:
-                    #print("returning default for policy at time = ", time)
-                    return default
+    def compile_policy(self, model, policy):
+        # compiles a Policy (lockdown and testing sub policies) into a PolicySchedule for this model and model case.
+        # The schedule can be solved repeatedly, e.g. for all sample batches in risk analysis.
+        if isinstance(policy, PolicySchedule):
+            return policy
 
+        lockdown_policy_control_days, lockdown_values = policy_arrays(policy.lockdown_policy)
+        testing_policy_control_days, testing_values = policy_arrays(policy.testing_policy)
 
+        return self.compile_policies(model, lockdown_policy_control_days, lockdown_values[np.newaxis, :],
+                                     testing_policy_control_days, testing_values[np.newaxis, :])
 
+    def compile_decisions(self, model, X, lockdown_policy_control_days, testing_policy_control_days):
+        # compiles an (N, n_var) decision matrix in the optimizer's format (see solve_case_batch) into a PolicySchedule
 
+        X = np.atleast_2d(np.asarray(X, dtype=float))
 
+        n_var_ld = 0 if lockdown_policy_control_days == "NA" else len(lockdown_policy_control_days)
+        n_var_t = 0 if testing_policy_control_days == "NA" else len(testing_policy_control_days)
 
-        for t in range(1, self.T):
+        return self.compile_policies(model, lockdown_policy_control_days, X[:, :n_var_ld],
+                                     testing_policy_control_days, X[:, n_var_ld:n_var_ld + n_var_t])
 
-            # calculate policy value for lockdown strength:
-            lockdown_eff = policy_timer(t, lockdown_policy, 1.0)
+    def compile_policies(self, model, lockdown_policy_control_days, lockdown_values, testing_policy_control_days,
+                         testing_values):
+        # compiles N policies, given as control days and (N, number of control days) arrays of policy values, into
+        # one PolicySchedule with the policy parameter values for each time step
 
-            lockdown_effs[t] = lockdown_eff
-            # print("at time ", t, " ksi_U_t = ", ksi_U_t)
+        time_steps = np.arange(self.T)
+        before_exp = time_steps <= model['d_start_exp'] # no testing or quarantine release before experiment starts
 
-            Mt = M_t[:, t - 1]      # compartment 'masses' from last computed time step
+        lockdown_eff = schedule_values(time_steps, self.Delta_time, lockdown_policy_control_days, lockdown_values, 1.0)
+        tau = schedule_values(time_steps, self.Delta_time, testing_policy_control_days, testing_values,
+                              model['tau_paramA'])
+        tau[:, before_exp] = 0
 
-            Mt_Q = np.sum(Mt[Q_inds])  # mass of people in quarantine t-1
-            Mt_NQ = np.sum(Mt[NQ_inds])  # mass of people out of quarantine t-1
+        # after vaccine, testing policy is no longer followed: testing continues at the last rate before vaccine
+        after_vaccine = (time_steps >= self.d_vaccine) & ~before_exp
+        if np.any(after_vaccine):
+            tau[:, after_vaccine] = tau[:, [np.argmax(after_vaccine) - 1]]
 
-            Mt_IANQ = np.sum(Mt[IANQ_inds])
-            Mt_IAQ = np.sum(Mt[IAQ_inds])
+        # first time steps of the policy periods
+        control_days = [days for days in (lockdown_policy_control_days, testing_policy_control_days) if days != "NA"]
+        control_steps = np.unique(np.ceil(np.concatenate([np.zeros(0)] + control_days) * self.Delta_time))
 
-            Mt_ISQ = np.sum(Mt[ISQ_inds])
+        return PolicySchedule(lockdown_eff, tau,
+                              tau_TT=np.where(before_exp, 0., model['tau_TT']),
+                              test_sens=np.where(before_exp, 1., model['test_sens']),
+                              test_spec=np.where(before_exp, 1., model['test_spec']),
+                              r_U=np.where(before_exp, 0., model['r_U']),
+                              r_R=np.where(before_exp, 0., model['r_R']),
+                              control_steps=control_steps.astype(int))
 
-            Mt_NANQ = np.sum(Mt[NANQ_inds])
-            Mt_RANQ = np.sum(Mt[RANQ_inds])
+    def _solve_batch(self, model, schedule, lean=False):
+        # lean: only the outputs needed for optimization objectives are returned, see solve_objectives_batch
 
-            Mt_NAQ = np.sum(Mt[NAQ_inds])
-            Mt_RAQ = np.sum(Mt[RAQ_inds])
+        assert schedule.lockdown_eff.shape[1] == self.T, "schedule compiled for a different model"
 
-            Mt_FP = np.sum(Mt[FP_inds])
-            Mt_FPQ = np.sum(Mt[FPQ_inds])
-            Mt_FN = np.sum(Mt[FN_inds])
-            Mt_FNNQ = np.sum(Mt[FNNQ_inds])
+        # number of rows solved together: one per policy, or one per sample if a single policy is solved
+        # for a sample-batched model
+        N = np.broadcast_shapes((len(schedule),), (self.n_samples,))[0]
+        # debugging prints:
+        #print("Solving model: ", model)
+        #print("Other params: ", self.__dict__)
 
-            # Masses of groups from which tested persons are selected:
-            Mt_test = np.sum(Mt[test_inds])
-            Mt_TT_test = np.sum(Mt[TT_test_inds])
+        M0_vec = np.zeros((N, 12))
+        M0_vec[:, 3] = self.InitialInfect / self.pop  # initial infected, asymptomatic, not quarantined, and unknown cases
+        M0_vec[:, 8] = 2. / self.pop  # initial infected, symptomatic, quarantined (and known) cases
+        M0_vec[:, 0] = 1 - np.sum(M0_vec, axis=1)
+
+        # Members in each state on different time steps, one row per policy. Time step t is kept in column t % H:
+        # in lean mode only the last H = 4 time steps needed by the update are kept instead of the full history.
+        # All per time step values are kept in one array, see SimulationResult for its rows. In lean mode tests and
+        # productivity are separate, and productivity is computed on each time step.
+        H = 4 if lean else self.T
+        data = np.zeros((N, 16 if lean else 18, H))
+        data[:, :12, 0] = M0_vec
+        M_t = data[:, :12]
+        alpha_T = data[:, 12] # alpha values will be saved in this one
+        ksi_TT_I_T = data[:, 13] # test and trace Q rate will be saved here
+        ksi_TT_N_T = data[:, 14]
+        ksi_TT_R_T = data[:, 15]
+        tests = np.zeros((N, self.T)) if lean else data[:, 16]
+        Y_t = np.zeros((N, self.T if lean else 0))
+
+        # policy values for each time step as rows (one value per policy)
+        lockdown_eff_T = np.ascontiguousarray(schedule.lockdown_eff.T)
+        tau_T = np.ascontiguousarray(schedule.tau.T)
+
+        # time step from which each row is solved. With prefix reuse (see PrefixStateTrie), policies are resumed from
+        # stored histories of earlier solved policies. Rows are then ordered by their resume time step, so that the
+        # rows solved on a time step are always the first ones.
+        start = np.ones(N, dtype=np.int64)
+        trie = self.prefix_trie if self.n_samples == 1 and not lean else None
+        if trie is not None:
+            start = trie.restore(schedule, (data,))
+            order = np.argsort(start, kind='stable')
+            start = start[order]
+            data = data[order]
+            M_t, alpha_T, ksi_TT_I_T, ksi_TT_N_T, ksi_TT_R_T, tests = \
+                data[:, :12], data[:, 12], data[:, 13], data[:, 14], data[:, 15], data[:, 16]
+            lockdown_eff_T = np.ascontiguousarray(lockdown_eff_T[:, order])
+            tau_T = np.ascontiguousarray(tau_T[:, order])
+
+        if self.use_jit:
+            # model parameters as one value per row for the compiled loop
+            row_params = [np.ascontiguousarray(np.broadcast_to(np.asarray(param, dtype=float), (N,)))
+                          for param in (self.lambda_param, self.lambda_paramQ, self.rhoS, self.rhoA, self.delta,
+                                        self.omegaR, self.omegaD, self.gamma, self.sigma, self.eta)]
+            # a single policy solved for a sample-batched model is repeated for every sample
+            solve_steps_jit(start, M_t, tests, alpha_T, ksi_TT_I_T, ksi_TT_N_T, ksi_TT_R_T, Y_t,
+                            np.ascontiguousarray(np.broadcast_to(lockdown_eff_T, (self.T, N))),
+                            np.ascontiguousarray(np.broadcast_to(tau_T, (self.T, N))),
+                            np.asarray(schedule.tau_TT, dtype=float), np.asarray(schedule.test_sens, dtype=float),
+                            np.asarray(schedule.test_spec, dtype=float), np.asarray(schedule.r_U, dtype=float),
+                            np.asarray(schedule.r_R, dtype=float), *row_params, float(self.pop),
+                            float(self.A_rel))
+
+        else:
+            # transition rates along the fixed edges of the model, constant rates are precomputed
+            kernel = TransitionKernel(self, N)
+
+            # 0/0 rates (e.g. no recovered at start) are handled explicitly below
+            with np.errstate(divide='ignore', invalid='ignore'):
+
+                for t in range(start.min(initial=self.T), self.T):
+
+                    n_t = np.searchsorted(start, t, side='right') # number of rows solved on this time step
+
+                    # policy values for lockdown strength and testing and model case rates at t:
+                    lockdown_eff = lockdown_eff_T[t, :n_t]
+                    tau_t = tau_T[t, :n_t]
+
+                    tau_TT = schedule.tau_TT[t]
+                    test_sens = schedule.test_sens[t]
+                    test_spec = schedule.test_spec[t]
+                    r_U_t = schedule.r_U[t]
+                    r_R_t = schedule.r_R[t]
+
+                    Mt = M_t[:n_t, :, (t - 1) % H].T      # compartment 'masses' from last computed time step, one row per compartment
+
+                    # sums over the compartment groups (index lists above) are written out explicitly
+                    Mt_Q = Mt[1] + Mt[4] + Mt[5] + Mt[6] + Mt[8] + Mt[10]  # mass of people in quarantine t-1
+                    Mt_NQ = Mt[0] + Mt[2] + Mt[3] + Mt[7] + Mt[9]  # mass of people out of quarantine t-1
+
+                    Mt_IANQ = Mt[3]
+                    Mt_IAQ = Mt[4] + Mt[5]
+
+                    Mt_ISQ = Mt[8]
+
+                    Mt_NANQ = Mt[0] + Mt[2]
+                    Mt_RANQ = Mt[9]
+
+                    Mt_NAQ = Mt[1]
+                    Mt_RAQ = Mt[10]
+
+                    Mt_FPQ = Mt[6]
+                    Mt_FNNQ = Mt[7]
+
+                    # Masses of groups from which tested persons are selected:
+                    Mt_test = Mt[0] + Mt[1] + Mt[3] + Mt[4]
+                    Mt_TT_test = Mt[1] + Mt[4]
+
+                    Mt_Total = lockdown_eff*self.lambda_param * Mt_NQ + self.lambda_paramQ * Mt_Q
+
+                    Mt_I = lockdown_eff*self.lambda_param * (Mt_IANQ + Mt_FNNQ) + self.lambda_paramQ * (
+                                Mt_IAQ + Mt_ISQ)  # added false negatives
+
+                    # conditional on meeting a person, the probability that they are infected (I)
+                    pit_I = Mt_I / Mt_Total
+
+                    # conditional on meeting an infected person, probability that they are asymptomatic
+                    pit_IA = (lockdown_eff*self.lambda_param * Mt_IANQ + self.lambda_paramQ * Mt_IAQ + lockdown_eff*self.lambda_param * Mt_FNNQ) / Mt_I  # added false negatives
+                    pit_IS = (self.lambda_paramQ * Mt_ISQ) / Mt_I
+
+                    alphat = pit_I * (pit_IS * self.rhoS + pit_IA * self.rhoA)
+                    alpha_T[:n_t, t % H] = alphat # saves the alpha for this time step
+
+
+                    # Test and trace rates:
+                    Mt_tm1 = M_t[:n_t, :, (t - 2) % H].T  # compartment 'masses' from previous to last computed time step
+                    Mt_tm2 = M_t[:n_t, :, (t - 3) % H].T  # compartment 'masses' from t-2 to last computed time step
+                    Mtm1_NANQ = Mt_tm1[0] + Mt_tm1[2]
+                    Mtm1_RNQ = Mt_tm1[9]
+                    Mtm2_IAQ = Mt_tm2[4] + Mt_tm2[5]
+                    Mtm2_IANQ = Mt_tm2[3]
+
+
+                    pit_ISTm1 = self.delta*(self.lambda_paramQ * Mtm2_IAQ + lockdown_eff* self.lambda_param * Mtm2_IANQ) / Mt_Total
+                    pit_IATm1 = (lockdown_eff * self.lambda_param * Mtm2_IANQ * tau_t + self.lambda_paramQ * Mtm2_IAQ * (tau_TT + tau_t) ) * test_sens / Mt_Total
+                    pit_FPm1 = (lockdown_eff * self.lambda_param * Mtm2_IANQ * tau_t + self.lambda_paramQ * Mtm2_IAQ * (tau_TT + tau_t) ) * (1-test_sens)  / Mt_Total
+
+                    # masses for traceable infected (TI) and not infected (TN) and recovered (TR)
+                    M_TI_t = lockdown_eff * self.lambda_param * (pit_ISTm1 * self.rhoS + pit_IATm1 * self.rhoA) * Mtm1_NANQ
+                    M_TN_t = lockdown_eff * self.lambda_param * (pit_ISTm1 * (1-self.rhoS) + pit_IATm1 * (1-self.rhoA) +  pit_FPm1) * Mtm1_NANQ
+                    M_TR_t = lockdown_eff * self.lambda_param * (
+                                pit_ISTm1 + pit_IATm1 + pit_FPm1) * Mtm1_RNQ
+
+                    ksi_TT_I = self.eta * M_TI_t / Mt_IANQ      # transition rate from IANQ to IAQ
+                    ksi_TT_N = self.eta * M_TN_t / Mt_NANQ      # transition rate from NANQ to NAQ
+                    ksi_TT_R = self.eta * M_TR_t / Mt_RANQ      # transition rate from RANQ to RAQ
+                    ksi_TT_R = np.where(np.isnan(ksi_TT_R), 0, ksi_TT_R)
 
-            Mt_Total = lockdown_eff*self.lambda_param * Mt_NQ + self.lambda_paramQ * Mt_Q
+                    ksi_TT_I_T[:n_t, t % H] = ksi_TT_I
+                    ksi_TT_N_T[:n_t, t % H] = ksi_TT_N
+                    ksi_TT_R_T[:n_t, t % H] = ksi_TT_R
 
-            Mt_I = lockdown_eff*self.lambda_param * (Mt_IANQ + Mt_FNNQ) + self.lambda_paramQ * (
-                        Mt_IAQ + Mt_ISQ)  # added false negatives
-            Mt_N = lockdown_eff*self.lambda_param * (Mt_NANQ + Mt_RANQ) + self.lambda_paramQ * (Mt_NAQ + Mt_RAQ + Mt_FPQ)
 
-            # conditional on meeting a person, the probability that they are infected (I) or not (N)
-            pit_I = Mt_I / Mt_Total
-            pit_N = Mt_N / Mt_Total
-
-            # conditional on meeting an infected person, probability that they are asymptomatic
-            pit_IA = (lockdown_eff*self.lambda_param * Mt_IANQ + self.lambda_paramQ * Mt_IAQ + lockdown_eff*self.lambda_param * Mt_FNNQ) / Mt_I  # added false negatives
-            pit_IS = (self.lambda_paramQ * Mt_ISQ) / Mt_I
-
-            alphat = pit_I * (pit_IS * self.rhoS + pit_IA * self.rhoA)
-            alpha_T[t] = alphat # saves the alpha for this time step
-
-
-            # A_daily just selects every 14th entry starting at the 14th entry (end of day each day)
-
-            if t <= model['d_start_exp']:
-                ksi_U_t = 0
-                ksi_P_t = 0
-                ksi_N_t = 0
-                ksi_R_t = 0
-
-                r_U_t = 0
-                r_P_t = 0
-                r_AP_t = 0
-                r_N_t = 0
-                r_R_t = 0
-
-                tau_t = 0
-                #tau_re_t = tau_t * self.delta / 2  # TODO: improve: approximation for retesting rate of positives if not symptomatic
-
-                test_sens = 1
-                test_spec = 1
-                tau_TT = 0
-
-            elif t >= self.d_vaccine:
-                ksi_U_t = model['ksi_U']
-                ksi_P_t = model['ksi_P']
-                ksi_N_t = model['ksi_N']
-                ksi_R_t = 0.
-
-                r_U_t = model['r_U']
-                r_P_t = model['r_P']
-                r_AP_t = model['r_AP']
-                r_N_t = model['r_N']
-                r_R_t = model['r_R']
-
-                test_sens = model['test_sens']
-                test_spec = model['test_spec']
-                tau_TT = model['tau_TT']
-                #tau_re_t = tau_t * self.delta / 2
-
-            else:
-                ksi_U_t = model['ksi_U']
-                ksi_P_t = model['ksi_P']
-                ksi_N_t = model['ksi_N']
-                ksi_R_t = model['ksi_R']
-
-                r_U_t = model['r_U']
-                r_P_t = model['r_P']
-                r_AP_t = model['r_AP']
-                r_N_t = model['r_N']
-                r_R_t = model['r_R']
-
-                tau_t = policy_timer(t, testing_policy, model['tau_paramA'])
-                tau_TT = model['tau_TT']
-                #tau_re_t = tau_t * self.delta / 2
-                test_sens = model['test_sens']
-                test_spec = model['test_spec']
-
-            # Test and trace rates:
-            Mt_tm1 = M_t[:, t - 2]  # compartment 'masses' from previous to last computed time step
-            Mt_tm2 = M_t[:, t - 3]  # compartment 'masses' from t-2 to last computed time step
-            Mtm1_IAQ = np.sum(Mt_tm1[IAQ_inds])
-            Mtm1_IANQ = np.sum(Mt_tm1[IANQ_inds])
-            Mtm1_NANQ = np.sum(Mt_tm1[NANQ_inds])
-            Mtm1_NAQ = np.sum(Mt_tm1[NAQ_inds])
-            Mtm1_RNQ = np.sum(Mt_tm1[RANQ_inds])
-            Mtm2_IAQ = np.sum(Mt_tm2[IAQ_inds])
-            Mtm2_IANQ = np.sum(Mt_tm2[IANQ_inds])
-            Mtm2_NANQ = np.sum(Mt_tm2[NANQ_inds])
-            Mtm2_NAQ = np.sum(Mt_tm2[NAQ_inds])
-
-
-            pit_ISTm1 = self.delta*(self.lambda_paramQ * Mtm2_IAQ + lockdown_eff* self.lambda_param * Mtm2_IANQ) / Mt_Total
-            pit_IATm1 = (lockdown_eff * self.lambda_param * Mtm2_IANQ * tau_t + self.lambda_paramQ * Mtm2_IAQ * (tau_TT + tau_t) ) * test_sens / Mt_Total
-            pit_FPm1 = (lockdown_eff * self.lambda_param * Mtm2_IANQ * tau_t + self.lambda_paramQ * Mtm2_IAQ * (tau_TT + tau_t) ) * (1-test_sens)  / Mt_Total
-
-            # masses for traceable infected (TI) and not infected (TN) and recovered (TR)
-            M_TI_t = lockdown_eff * self.lambda_param * (pit_ISTm1 * self.rhoS + pit_IATm1 * self.rhoA) * Mtm1_NANQ
-            M_TN_t = lockdown_eff * self.lambda_param * (pit_ISTm1 * (1-self.rhoS) + pit_IATm1 * (1-self.rhoA) +  pit_FPm1) * Mtm1_NANQ
-            M_TR_t = lockdown_eff * self.lambda_param * (
-                        pit_ISTm1 + pit_IATm1 + pit_FPm1) * Mtm1_RNQ
-
-            ksi_TT_I = self.eta * M_TI_t / Mt_IANQ      # transition rate from IANQ to IAQ
-            ksi_TT_N = self.eta * M_TN_t / Mt_NANQ      # transition rate from NANQ to NAQ
-            ksi_TT_R = self.eta * M_TR_t / Mt_RANQ      # transition rate from RANQ to RAQ
-            if isnan(ksi_TT_R): ksi_TT_R = 0
-
-            ksi_TT_I_T[t] = ksi_TT_I
-            ksi_TT_N_T[t] = ksi_TT_N
-            ksi_TT_R_T[t] = ksi_TT_R
-
-
-            #print("ksi_I:", ksi_TT_I)
-            #print("ksi_N:", ksi_TT_N)
-            #print("ksi_R:", ksi_TT_R)
-            #print("pit_IST:", pit_IST)
-            #print("pit_IAT:", pit_IAT)
-            #print("pit_N:", pit_N)
-            #print("pit_FP:", pit_FP)
-
-            # Create transition matrix and fill it with correct values
-            transition_matrix_t = np.zeros((12, 12))
-
-            # from not known NA, NQ - Not infected Asymptomatic, Not Quarantined
-            transition_matrix_t[0, 1] = ksi_TT_N  # To NA, Quarantined, based on test & trace
-            transition_matrix_t[0, 2] = tau_t * test_spec  # To known not-infected asymptomatic, NQ
-            transition_matrix_t[0, 3] = lockdown_eff * self.lambda_param * alphat  # To unknown infected asympt., not NQ
-            transition_matrix_t[0, 6] = tau_t * (1.0 - test_spec)  # to false positive, NQ
-
-
-            # from not known NA, Q - Not infected Asymptomatic, Quarantined
-            transition_matrix_t[1, 0] = r_U_t
-            transition_matrix_t[1, 2] = (tau_t + tau_TT) * test_spec  # To known not-infected asymptomatic, Quarantined
-            transition_matrix_t[1, 4] = self.lambda_paramQ * alphat
-            transition_matrix_t[1, 6] = (tau_t + tau_TT) * (1.0 - test_spec)  # To false positive, Quarantined
-
-            # from known NA, NQ - Not infected Asymptomatic, Not Quarantined
-            transition_matrix_t[2, 0] = self.sigma
-            transition_matrix_t[2, 3] = lockdown_eff * self.lambda_param * alphat  # To unknown infected asymptomatic, not NQ
-
-
-            # from not known IA, NQ - Infected Asymptomatic, Not Quarantined
-            transition_matrix_t[3, 4] = ksi_TT_I
-            transition_matrix_t[3, 5] = tau_t * test_sens  # To known infected asymptomatic, Q
-            transition_matrix_t[3, 7] = tau_t * (1.0 - test_sens)  # To false negative, NQ
-            transition_matrix_t[3, 8] = self.delta
-            transition_matrix_t[3, 9] = self.omegaR
-
-            # from not known IA, Q - Infected Asymptomatic, Quarantined
-            transition_matrix_t[4, 3] = r_U_t
-            transition_matrix_t[4, 5] = tau_TT * test_sens  # To known infected asymptomatic, Quarantined
-            transition_matrix_t[4, 7] = tau_TT * (1.0 - test_sens)  # to false negative, Quarantined
-            transition_matrix_t[4, 8] = self.delta
-            transition_matrix_t[4, 10] = self.omegaR
-
-            # from known IA, Q - Infected Asymptomatic, Quarantined
-            transition_matrix_t[5, 8] = self.delta
-            transition_matrix_t[5, 10] = self.omegaR
-
-            # from false Positive, Quarantined (index 9)
-            # i.e. not infected asymptomatic but treated like infected
-            transition_matrix_t[6, 0] = self.omegaR
-            transition_matrix_t[6, 5] = self.lambda_paramQ * alphat  # to known infected, quarantined (actually gets infected) 'infection while in Q rate'
-
-            # from False Negative, Not Quarantined (index 10)
-            # i.e. infected (asymptomatic) but treated like not infected
-
-            transition_matrix_t[7, 8] = self.delta  # to infected symptomatic not quarantined  - assume infection diagnosed correctly then - "symptom dev rate"
-            transition_matrix_t[7, 9] = self.omegaR
-
-
-            # from (known) Infected Symptomatic, Quarantined
-            transition_matrix_t[8, 10] = self.omegaR
-            transition_matrix_t[8, 11] = self.omegaD
-
-            # from Recovered Asymptomatic, Not Quarantined
-            transition_matrix_t[9, 0] = self.gamma  # immunity loss
-            transition_matrix_t[9, 10] = ksi_TT_R
-
-            # from Recovered Asymptomatic, Quarantined
-            transition_matrix_t[10, 9] = r_R_t
+                    #print("ksi_I:", ksi_TT_I)
+                    #print("ksi_N:", ksi_TT_N)
+                    #print("ksi_R:", ksi_TT_R)
+
+                    # M_t at t calculated from previous time step by applying the flows along all edges
+                    kernel.set_rates(lockdown_eff, tau_t, tau_TT, test_sens, test_spec, r_U_t, r_R_t, alphat, ksi_TT_I,
+                                     ksi_TT_N, ksi_TT_R)
+                    kernel.apply(M_t[:n_t, :, (t - 1) % H], M_t[:n_t, :, t % H])
+                    tests[:n_t, t] = (Mt_test*tau_t + Mt_TT_test*tau_TT)*self.pop
+
+                    if lean:
+                        M_next = M_t[:n_t, :, t % H].T
+                        Y_t[:n_t, t] = lockdown_eff * (M_next[0] + M_next[2] + M_next[3] + M_next[7] + M_next[9]) + \
+                                       self.A_rel * (M_next[1] + M_next[4] + M_next[5] + M_next[6] + M_next[10])
 
-            # probabilities for staying in same compartment
-            transition_matrix_t += np.diag(1 - np.sum(transition_matrix_t, axis=1))
+        if trie is not None:
+            # back to the order of the schedule
+            data = data[np.argsort(order)]
+            M_t = data[:, :12]
 
-            # This tests that there are no clearly faulty values in the matrix
+        if lean:
+            # productivity at the initial time step (no lockdown) and objective outputs as in the full mode below
+            M0 = M0_vec.T
+            Y_t[:, 0] = 0 * (M0[0] + M0[2] + M0[3] + M0[7] + M0[9]) + \
+                        self.A_rel * (M0[1] + M0[4] + M0[5] + M0[6] + M0[10])
 
-            assert np.min(transition_matrix_t) >= 0, transition_matrix_t
-            assert np.max(transition_matrix_t) <= 1, transition_matrix_t
+            Dead_D = M_t[:, 11, [(self.T - 1) % H]]
+            Dead_T = M_t[:, 11, [(self.T - 2) % H, (self.T - 1) % H]]
+            Y_D = Y_t[:, -1:]
+            Y_total = np.sum(Y_t, axis=1)
+            tests_D = np.sum(tests.reshape(N, -1, 14), axis=2)
+            return Dead_D, Dead_T, Y_D, Y_total, tests_D
 
-            # M_t at t calculated from previous time step Mt and transitions thru matrix multiplication
-            # .T is transpose
-            # @ is matrix multiplication
-            M_t[:, t] = transition_matrix_t.T @ Mt
-            tests[t] = (Mt_test*tau_t + Mt_TT_test*tau_TT)*self.pop
+        # lockdown strength is not applied at the initial time step
+        lockdown_effs = schedule.lockdown_eff.copy()
+        lockdown_effs[:, 0] = 0
 
         # Total productivity = productivity of non quarantined + productivity of quarantined non-symptomatic
-        Y_t = lockdown_effs * np.sum(M_t[[0, 2, 3, 7, 9]], axis=0) + \
-              self.A_rel * np.sum(M_t[[1, 4, 5, 6, 10]], axis=0)
-
-        Reported_T_start = self.pop * ((test_sens * tau_t + self.delta) * M_t[3] + (test_sens * tau_TT + self.delta) * M_t[4] + test_spec * tau_t * M_t[0] + test_spec * (tau_t + tau_TT) * M_t[1] ) # reported calculated from tested cases
-        Reported_T_start[0] = 0
-        Reported_T = np.cumsum(Reported_T_start)
-
-        Reported_D = Reported_T[13::14]  # Note: 13::14 refers to time indices, i.e. 'end of day for all days'
-        Notinfected_D = np.sum(M_t[[0, 1, 2]], axis=0)[13::14]
-        Unreported_D = np.sum(M_t[[3, 4]], axis=0)[13::14]
-        Infected_D = (np.sum(M_t[[3, 4, 5]], axis=0) + np.sum(M_t[[7, 8]], axis=0))[13::14]
-        Infected_in_Q = np.sum(M_t[[4, 5, 8]], axis=0)[
-                        13::14]  # includes all infected in quarantine including false negs
-        Infected_not_Q = np.sum(M_t[[3, 7]], axis=0)[13::14]  # includes false negatives
-        Symptomatic_D = np.sum(M_t[ISQ_inds], axis=0)[13::14]
-        False_pos = np.sum(M_t[[6]], axis=0)[13::14]
-        False_neg = np.sum(M_t[[7]], axis=0)[13::14]
-        Recovered_D = np.sum(M_t[[9,10]], axis=0)[13::14]
-        Dead_D = M_t[11][13::14]    # Dead at end of each day
-        Dead_T = M_t[11]
-        Infected_T = np.sum(M_t[[3, 4, 5]], axis=0) + np.sum(M_t[[7, 8]], axis=0)
-        Y_D = Y_t[13::14] # end of day output value
-        Y_total = np.sum(Y_t)
-        total_cost = sum(tests)*self.test_cost
-
-        Unk_NA_nQ_D = M_t[0][13::14]
-        Unk_NA_Q_D = M_t[1][13::14]
-        K_NA_nQ_D = M_t[2][13::14]
-        Unk_IA_nQ_D = M_t[3][13::14]
-        Unk_IA_Q_D = M_t[4][13::14]
-        K_IA_Q_D = M_t[5][13::14]
-        tests_D = list(map(sum, np.split(tests, len(tests)/14) )) # sums up total daily testing numbers
-        ksi_TT_I_D = ksi_TT_I_T[13::14]
-        ksi_TT_N_D = ksi_TT_N_T[13::14]
-        ksi_TT_R_D = ksi_TT_R_T[13::14]
-        alpha_D = alpha_T[13::14]
-
-        return Reported_D, Notinfected_D, Unreported_D, Infected_D, \
-               False_pos, False_neg, Recovered_D, Dead_D, Infected_T, Infected_not_Q, Infected_in_Q, Y_D, M_t, Y_total, total_cost, tests_D, Unk_NA_nQ_D, Unk_NA_Q_D, K_NA_nQ_D, Unk_IA_nQ_D, Unk_IA_Q_D, K_IA_Q_D, alpha_D, ksi_TT_I_D, ksi_TT_N_D, ksi_TT_R_D, Symptomatic_D, Dead_T
+        data[:, 17] = lockdown_effs * np.sum(M_t[:, [0, 2, 3, 7, 9]], axis=1) + \
+                      self.A_rel * np.sum(M_t[:, [1, 4, 5, 6, 10]], axis=1)
+
+        if trie is not None:
+            trie.store(schedule, (data,))
+
+        # outputs use the last time step rates for reported cases
+        return SimulationResult(data, np.broadcast_to(schedule.tau[:, -1], (N,)), schedule.tau_TT[-1],
+                                schedule.test_sens[-1], schedule.test_spec[-1], np.broadcast_to(self.delta, (N,)),
+                                self.pop, self.test_cost)
 
     def solve_model(self, lockdown_policy={10000: 0}, testing_policy = {10000: 0}):
         Reported_D_base, Notinfected_D_base, Unreported_D_base, Infected_D_base, \
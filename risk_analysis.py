@@ -1,11 +1,12 @@
 import numpy as np
-from scipy.stats import truncnorm
+from scipy.stats import truncnorm, norm, gamma, beta, uniform
 import pandas as pd
 
-from run_tools import create_epidemic_model, create_sub_policy, create_policy
+from run_tools import create_sub_policy, create_policy, read_policy_schema
+from risk_tools import RiskSampleStore, StreamingCVaR, OverloadCounter, classify_risk, unit_samples, init_risk_worker, simulate_risk_batch, imap_bounded, risk_store_path, risk_manifest_path, RiskManifest, sample_bank_path, save_sample_bank, load_sample_bank
 from run_definitions import get_runs_definitions, p_ICU_def, C_hos_def, T_rec_def
-from math import floor
 import argparse
+from multiprocessing import Pool
 from progress.bar import Bar
 
 from run_definitions import initial_infect_default
@@ -20,6 +21,16 @@ parser.add_argument('runs', type=str, nargs='+', help='dictionary of run values
 parser.add_argument('--file_suffix', type=str, help='suffix to add to the end on filename')
 parser.add_argument('--policy_file', type=str, help='Optional. If set, policies are read from this file instead of one determined by run and result set id.')
 parser.add_argument('--params', type=str, nargs='+', help='parameters to include in sensitivity analysis, see definitions for all available.')
+parser.add_argument('--batch_size', type=int, default=50, help='number of parameter samples simulated together. Peak memory use grows linearly with this: about 2.2 MB per sample (the 1.5 MB history of 18 x 10220 time step values plus derived outputs), on top of about 160 MB for Python and the libraries.')
+parser.add_argument('--sampler', type=str, default='random', choices=['random', 'lhs', 'sobol'], help='parameter sampling: independent random draws, Latin hypercube or scrambled Sobol sequence')
+parser.add_argument('--seed', type=int, default=12345, help='seed of the random number generator used for parameter samples')
+parser.add_argument('--sample_bank', type=str, help='Optional. Parameter sample bank file (.npy) to read samples from, or to draw them to if it does not exist or does not match the sampling definitions. Default: one per sampler and seed (and sample size for lhs) in active_results/risk_analysis.')
+parser.add_argument('--workers', type=int, default=1, help='number of worker processes simulating (policy, sample batch) units in parallel. Results do not depend on this.')
+parser.add_argument('--restart', action='store_true', help='analyse all policies again, ignoring policies completed by an earlier interrupted job with the same settings')
+parser.add_argument('--P_threshold', type=float, help='Optional. Threshold for max ICU overload probability. If set, samples are simulated in batches until the policy is confidently classified against it (adaptive sample size, sample_size is the maximum).')
+parser.add_argument('--CVaR_threshold', type=float, help='Optional. Threshold for ICU overload CVaR 10%%, used like --P_threshold. If both are set, both must be classified.')
+parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the intervals used in adaptive sample size')
+parser.add_argument('--min_samples', type=int, help='smallest number of samples simulated for a policy in adaptive sample size. Default: batch_size.')
 #parser.add_argument('--policy_index', type=int, help='Optional. If set, the corresponding policy from policy_file is used as policy for sample simulations')
 
 
@@ -30,6 +41,19 @@ set_id = args.result_set
 file_suffix = args.file_suffix
 policy_file = args.policy_file
 params_sel = args.params # list of parameters to include in sensitivity analysis
+batch_size = args.batch_size
+sampler = args.sampler
+sample_bank = args.sample_bank
+restart = args.restart
+workers = args.workers
+P_threshold = args.P_threshold
+CVaR_threshold = args.CVaR_threshold
+adaptive = P_threshold != None or CVaR_threshold != None # adaptive sample size: stops when policy risk is classified
+z_confidence = norm.ppf(0.5 + args.confidence / 2) # two-sided interval
+min_samples = args.min_samples
+
+if min_samples == None:
+    min_samples = batch_size
 
 if file_suffix == None:
     file_suffix = ""
@@ -38,67 +62,61 @@ run_definitions = get_runs_definitions()
 
 runs = { run: run_definitions[run] for run in run_list } # filters the correct run definitions based on given run list
 
+# risk results columns, the number of samples simulated differs between policies only in adaptive sample size
+risk_columns = ['ICUOL (CVaR 10%)', 'max ICUOL P'] + (['samples'] if adaptive else [])
+
+def write_risk_results(run_results_df, risk_results, path):
+    # writes the results of the policies completed so far (dictionary: policy id -> risk results), in policy file order
+    completed_ids = [policy_id for policy_id in run_results_df.index if policy_id in risk_results]
+    full_results = run_results_df.loc[completed_ids].copy()
+
+    loc = len(full_results.columns)
+    for i, column in enumerate(risk_columns):
+        full_results.insert(loc+i, column, [risk_results[policy_id][column] for policy_id in completed_ids])
+    full_results.to_csv(path)
+
 def trunc_norm_builder(my_lower, my_upper, mu, sigma):
     lower  = (my_lower - mu) / sigma
     upper = (my_upper - mu) / sigma
     return truncnorm(lower, upper, loc=mu, scale=sigma).rvs(1)[0]
 
-def sample_CVaR(sample, alpha, lowest_alpha=True):
-
-    # this function calculates a CVaR -type 'worst case' expectation value for event mass corresponding to alpha
-    # e.g. of sample group of N=100, this selects 10 worst values and calculates their average
-    # lowest_alpha controls if the alpha share is selected from the low end (or the high end) of sample. If true the
-    # lowest alpha_N values are used.
-
-    sample_size = len(sample)
-    #print("sample size:", sample_size)
-    #print("alpha*sample size: ", sample_size*alpha, " --> ", floor(sample_size*alpha))
-    alpha_N = floor(sample_size*alpha) # number of cases corresponding to share alpha
-
-    sample.sort(reverse=lowest_alpha)
-    if alpha_N !=0:    # makes sure -0 doesn't cause trouble in calculating worst_alpha
-        worst_alpha = sample[-alpha_N:]
-    else:
-        worst_alpha = []
-
-    remainder = (sample_size*alpha - alpha_N)*sample[-(alpha_N+1)]
-    #print("worst alpha: ", worst_alpha, " remainder: ", remainder, 'from', sample[-(alpha_N+1)])
-
-    return (sum(worst_alpha)+remainder)/(sample_size*alpha)
-
-
 # get parameter value samples:
 #print("run: ", runs[run])
-sample_list = []
 
 ### INPUT RISK ANALYSIS DEFINITIONS BELOW! ###
 
 analysis_params = {}
-rng = np.random.default_rng(12345) # creates a random number generator with constant seed sequence
+rng = np.random.default_rng(args.seed) # creates a random number generator with constant seed sequence
 
+# '_dist' draws a random sample, 'inv_cdf' maps a point in (0, 1) to the same distribution (used by lhs and sobol)
 analysis_params['R_0']= {
     '_dist': rng.gamma,
-    'dist_params': (100,0.025)  # (low, high) for uniform
+    'dist_params': (100,0.025),  # (low, high) for uniform
+    'inv_cdf': gamma(100, scale=0.025).ppf
 }
 
 analysis_params['pii_D'] = {
     '_dist': rng.beta,
-    'dist_params': (1.45, 95) # (low, high) for uniform
+    'dist_params': (1.45, 95), # (low, high) for uniform
+    'inv_cdf': beta(1.45, 95).ppf
 }
 
 analysis_params['delta_param']= {
     '_dist': rng.gamma,
-    'dist_params': (2.81, 2.385)
+    'dist_params': (2.81, 2.385),
+    'inv_cdf': gamma(2.81, scale=2.385).ppf
 }
 
 analysis_params['gamma_param'] = {
     '_dist': rng.uniform,
-    'dist_params': (150, 240)
+    'dist_params': (150, 240),
+    'inv_cdf': uniform(150, 240 - 150).ppf
 }
 
 analysis_params['initial_infect'] = {
     '_dist': rng.uniform,
-    'dist_params': (initial_infect_default / 2, initial_infect_default * 1.5)
+    'dist_params': (initial_infect_default / 2, initial_infect_default * 1.5),
+    'inv_cdf': uniform(initial_infect_default / 2, initial_infect_default).ppf
 }
 
 
@@ -106,19 +124,49 @@ if params_sel == None:  # if no params are listed, default is to use all.
     params_sel = analysis_params.keys()
 
 
-param_values = {}
+# parameter samples are read from the sample bank (drawn and saved there once), for all analysis params, so that
+# runs and policies analysed with the same sampler and seed use the same samples.
+bank_params = list(analysis_params.keys())
+bank_metadata = {'params': bank_params, 'sampler': sampler, 'seed': args.seed,
+                 'dist_params': {p: list(analysis_params[p]['dist_params']) for p in bank_params}}
+if sample_bank == None:
+    sample_bank = sample_bank_path(sampler, args.seed, sample_size)
+
+# random and Sobol samples of a larger bank start with the samples of a smaller one, Latin hypercube samples do not
+prefix_samples = sampler != 'lhs'
+bank_samples = load_sample_bank(sample_bank, bank_metadata, sample_size, prefix_samples)
+
+if bank_samples is None:
+    print("Draws parameter samples to: ", sample_bank)
+    param_values = {}
 
+    for p in bank_params:  # creates an empty array for each param for storing sample values
+        param_values[p] = []
+
+    if sampler == 'random':
+        for i in range(0, sample_size):
+            sample_instance = {}
+            for param in bank_params:
+                sample_instance[param] = analysis_params[param]['_dist'](*analysis_params[param]['dist_params']) # saves param value to sample point
+                param_values[param].append(sample_instance[param]) # saves the param value to param specific list
+
+    else:
+        # stratified / low discrepancy points of the unit cube, one dimension per parameter, mapped through the inverse
+        # CDFs of the parameter distributions
+        unit_points = unit_samples(sampler, sample_size, len(bank_params), rng)
+        for d, param in enumerate(bank_params):
+            param_values[param] = list(analysis_params[param]['inv_cdf'](unit_points[:, d]))
 
-for p in params_sel:  # creates an empty array for each param for storing sample values
-    param_values[p] = []
+    save_sample_bank(sample_bank, np.column_stack([param_values[p] for p in bank_params]), bank_metadata,
+                     prefix_samples)
+    bank_samples = load_sample_bank(sample_bank, bank_metadata, sample_size, prefix_samples)
 
-for i in range(0, sample_size):
-    sample_instance = {}
-    for param in params_sel:
-        sample_instance[param] = analysis_params[param]['_dist'](*analysis_params[param]['dist_params']) # saves param value to sample point
-        param_values[param].append(sample_instance[param]) # saves the param value to param specific list
+else:
+    print("Reads parameter samples from: ", sample_bank)
 
-    sample_list.append(sample_instance)
+# parameter samples as arrays, one value per sample. These are fed to the model as is: each sample is one row
+# of a sample-batched simulation.
+param_arrays = {p: np.array(bank_samples[:, bank_params.index(p)]) for p in params_sel}
 
 for run in runs:
 
@@ -134,20 +182,62 @@ for run in runs:
     run_results_df = pd.read_csv(file_path, delimiter=',')
     run_policies_df = run_results_df.drop(columns=['Deaths', 'Economic impact', 'cluster'], errors='ignore')
 
-    # next lines extract control times from column names by evaluating the string into a tuple and picking out
-    # the times from the tuple. The times are then mapped to integers and listed.
-    ld_control_times = list(map(int, [eval(tup)[1] for tup in run_policies_df.columns if eval(tup)[0] == 'ld']))
-    test_control_times = list(map(int, [eval(tup)[1] for tup in run_policies_df.columns if eval(tup)[0] == 'test']))
-
-    run_policy_samples = {}
-    policy_CVaRs = []
-    policy_ICUOL_Ps = []
+    # control types and times of the policy columns, from the schema saved with the policy file (or parsed from the
+    # column names), and the policy values of each control type as arrays
+    policy_schema = read_policy_schema(file_path, run_policies_df.columns)
+    ld_control_times = policy_schema.control_days('ld')
+    test_control_times = policy_schema.control_days('test')
+    ld_values = policy_schema.values(run_policies_df, 'ld')
+    test_values = policy_schema.values(run_policies_df, 'test')
+
+    try:
+        p_ICU = runs[run]['p_ICU']
+    except:
+        p_ICU = p_ICU_def
+
+    try:
+        C_hos= runs[run]['C_hos']
+    except:
+        C_hos = C_hos_def
+
+    try:
+        T_rec = runs[run]['T_rec']
+    except:
+        T_rec = T_rec_def
+
+    sample_store = RiskSampleStore(param_arrays, sample_bank) # sample results of all policies of the run
+    store_path = risk_store_path(run, set_id, file_suffix)
+    risk_path = 'active_results/risk_analysis/'+run+'_' + set_id + '_risk' + file_suffix +'.csv'
+
+    # completed policies are recorded in a manifest (and their sample results saved as shards of the store) one by
+    # one, so that an interrupted job continues from the first policy not completed. The risk results file is
+    # rewritten with each completed policy (it has one small row per policy), the shards are merged into the store
+    # at the end of the run. Adaptive sample size stops at batch boundaries, so the batch size is part of the
+    # settings.
+    manifest = RiskManifest(risk_manifest_path(run, set_id, file_suffix), restart=restart,
+                            settings={'run': run, 'policy_file': file_path, 'sample_size': sample_size,
+                                      'params': list(params_sel), 'sampler': sampler, 'seed': args.seed,
+                                      'sample_bank': sample_bank, 'P_threshold': P_threshold,
+                                      'CVaR_threshold': CVaR_threshold, 'confidence': args.confidence,
+                                      'min_samples': min_samples, 'batch_size': batch_size})
+    risk_results = {policy_id: results for (manifest_run, policy_id), results in manifest.completed.items()}
+    if len(risk_results) > 0:
+        try:
+            sample_store.restore(store_path, list(risk_results.keys()))
+            print("Resumes from manifest, completed policies: ", len(risk_results))
+        except (OSError, KeyError):
+            print("Sample results of completed policies not found, analyses all policies")
+            risk_results = {}
 
 
-    bar = Bar('Simulating policies', max=len(run_policies_df.index))
-    for policy_id, policy in run_policies_df.iterrows():
+    # policies not completed by an earlier job
+    pending_policies = {}
+    for i, policy_id in enumerate(run_policies_df.index):
         #print("\npolicy id: ", policy_id, ": ", policy) # debug
 
+        if policy_id in risk_results: # completed by an earlier job
+            continue
+
         # create policy for run:
 
         try:
@@ -161,110 +251,100 @@ for run in runs:
             testing_only = False
 
         if lockdown_only:
-            ld_policy = create_sub_policy(ld_control_times, policy)
+            ld_policy = create_sub_policy(ld_control_times, ld_values[i])
             test_policy = "NA"
 
         elif testing_only:
-            test_policy = create_sub_policy(test_control_times, policy)
+            test_policy = create_sub_policy(test_control_times, test_values[i])
             ld_policy = "NA"
 
         else:
-            # ld_control_times = run_control_times[:len(run_control_times)//2]
-            ld_policy = create_sub_policy(ld_control_times, policy[:len(ld_control_times)])
-
-            # test_control_times = run_control_times[len(run_control_times)//2:]
-            test_policy = create_sub_policy(test_control_times, policy[len(ld_control_times):])
+            ld_policy = create_sub_policy(ld_control_times, ld_values[i])
+            test_policy = create_sub_policy(test_control_times, test_values[i])
 
 
-        run_policy = create_policy(ld_policy, test_policy)
+        pending_policies[policy_id] = create_policy(ld_policy, test_policy)
 
-        policy_result_dist = {}
-        policy_sample_ICUover = []
-        policy_sample_ICU_bool = []
+    # (policy, sample batch) work units are simulated in policy and batch order, in the main process or, with several
+    # workers, in a process pool with at most one unit per worker in progress, so that units of policies completed
+    # meanwhile are not started (at most workers - 1 units of a policy are simulated after it is complete). Results
+    # are merged in the same order, so they do not depend on the number of workers.
+    n_batches = len(range(0, sample_size, batch_size))
+    stopped_policies = set() # policies with results complete, their remaining units are skipped
 
-        for sample_id, sample in enumerate(sample_list):
-
-            sample_run_params = runs[run].copy() # copies the original run (e.g. 'romer') for updating with sample values
-            sample_run_params.update(sample)
-
-            # calculate results
-
-            epidemic_simulator = create_epidemic_model(**sample_run_params)
-            Reported_D, Notinfected_D, Unreported_D, Infected_D, \
-            False_pos, False_neg, Recovered_D, Dead_D, Infected_T, Infected_not_Q, Infected_in_Q, Y_D, M_t, Y_total, total_testing_cost, tests, Unk_NA_nQ_D, Unk_NA_Q_D, K_NA_nQ_D, Unk_IA_nQ_D, Unk_IA_Q_D, K_IA_Q_D, alpha_D, ksi_TT_I_D, ksi_TT_N_D, ksi_TT_R_D, Symptomatic_T, Dead_T  \
-                = epidemic_simulator[0].solve_case(epidemic_simulator[1], run_policy)
-
-            # calculating aggregated ICU capacity overload:
-
-            try:
-                p_ICU = runs[run]['p_ICU']
-            except:
-                p_ICU = p_ICU_def
-
-            try:
-                C_hos= runs[run]['C_hos']
-            except:
-                C_hos = C_hos_def
-
-            ICU_use_T = p_ICU * Symptomatic_T
-            ICU_margin_T = ICU_use_T - (C_hos / epidemic_simulator[0].pop)
-            ICU_overuse_T = np.max([ICU_margin_T], initial=0.0, axis=0) # this creates a vector which has non-zero values for overuse, 0 otherw.
-            ICU_overuse_agg = np.sum(ICU_overuse_T)
-
-
-            try:
-                T_rec = runs[run]['T_rec']
-            except:
-                T_rec = T_rec_def
-
-            T_rec_t = int(round(14 * 365 * T_rec))  # change from years to time steps
-            # Costs:
-            cost_e = -Y_total / epidemic_simulator[0].T  # contains loss of output & scaled direct costs
-            cost_terminal = ((T_rec_t) / 2) * (-Y_D[-1]) / epidemic_simulator[0].T
-            deaths_terminal = ((T_rec_t) / 2) * ((Dead_D[-1] - Dead_D[
-                -2]) * epidemic_simulator[0].pop / 1000) / epidemic_simulator[0].T  # Deaths are cumulative, so difference needed for current rate
-            # hcap_terminal = ((T_rec_t) / 2) * np.max([0.0, self.p_ICU * Symptomatic_T[-1] - self.C_hos / self.model.pop])
-            # print("cost_e: ", cost_e)
-            # print("cost_terminal: ", cost_terminal)
-
-            # objectives scaled in same way as in optimizer objective calculation!
-            scaling = epidemic_simulator[0].T_years / (T_rec/2 + epidemic_simulator[0].T_years)
-            deaths_norm_adj = Dead_D[-1] * epidemic_simulator[0].pop / 1000 + deaths_terminal
-            output_norm_adj = scaling * (cost_e + cost_terminal)
-
-            policy_result_dist[sample_id] = [deaths_norm_adj, output_norm_adj, ICU_overuse_agg]
-            policy_sample_ICUover.append(ICU_overuse_agg)
-
-            ICU_overuse_T_bool = list(map(bool, ICU_overuse_T))
-            policy_sample_ICU_bool.append(ICU_overuse_T_bool)
-
-        #print("overload in sample: ", policy_sample_ICUover)
-        policy_CVaR = 340000000*sample_CVaR(policy_sample_ICUover, 0.1, False)
-        policy_CVaRs.append(policy_CVaR)
-        #print("policy CVaR 10%: ", 340000000*sample_CVaR(policy_sample_ICUover, 0.1, False))
-
-        #print("policy sample ICU bool: ", policy_sample_ICU_bool)
-        max_sample_overloads_T = max(np.sum(policy_sample_ICU_bool, axis=0))
-        max_P_ICU_overload = max_sample_overloads_T / sample_size
-        policy_ICUOL_Ps.append(max_P_ICU_overload)
-
-        # saving results to csv files
-        df = pd.DataFrame.from_dict(policy_result_dist, orient='index', columns=['Deaths', 'Output', 'ICU overload'])
-        #print("df: ", df)
-        #print("sample: ", sample_pii_Ds)
-        for p in params_sel: # inserts the param value lists to df
-            df.insert(0, p, param_values[p])
+    def risk_units():
+        for policy_id, run_policy in pending_policies.items():
+            for batch in range(n_batches):
+                if policy_id not in stopped_policies:
+                    yield policy_id, run_policy, batch
 
+    worker_args = (runs[run], param_arrays, batch_size, p_ICU, C_hos, T_rec)
+    if workers > 1:
+        pool = Pool(workers, initializer=init_risk_worker, initargs=worker_args)
+        batch_results = imap_bounded(pool, simulate_risk_batch, risk_units(), workers)
+    else:
+        pool = None
+        init_risk_worker(*worker_args)
+        batch_results = map(simulate_risk_batch, risk_units())
 
-        df.to_csv('active_results/risk_analysis/'+run+'__'+str(policy_id) + set_id + '_' + file_suffix + '.csv')
+    bar = Bar('Simulating policies', max=len(run_policies_df.index))
+    bar.next(len(risk_results))
+    policy_results = {} # policy id -> sample results, CVaR and overload accumulators of policies in progress
+    for policy_id, batch, batch_result, batch_overloads in batch_results:
+
+        if policy_id in stopped_policies: # unit started before the policy was complete
+            continue
+
+        if policy_id not in policy_results:
+            policy_results[policy_id] = ([],
+                                         StreamingCVaR(sample_size, 0.1, False), # CVaR 10% of aggregated ICU overload
+                                         OverloadCounter()) # overloaded samples per time step
+        policy_result_dist, policy_ICUover_CVaR, policy_ICU_overloads = policy_results[policy_id]
+
+        policy_result_dist.append(batch_result)
+        policy_ICUover_CVaR.add(batch_result[:, 2])
+        policy_ICU_overloads.add(batch_overloads)
+
+        complete = batch == n_batches - 1
+
+        # adaptive sample size: stops when the confidence intervals of the risk measures are on one side of the
+        # thresholds
+        if adaptive and policy_ICU_overloads.samples >= min_samples:
+            classified = True
+            if P_threshold != None:
+                P_interval = policy_ICU_overloads.interval(z_confidence)
+                classified = classified and classify_risk(P_interval, P_threshold) != 0
+            if CVaR_threshold != None:
+                CVaR_interval = policy_ICUover_CVaR.interval(z_confidence)
+                CVaR_interval = (340000000*CVaR_interval[0], 340000000*CVaR_interval[1])
+                classified = classified and classify_risk(CVaR_interval, CVaR_threshold) != 0
+            complete = complete or classified
+
+        if not complete:
+            continue
+
+        stopped_policies.add(policy_id)
+        del policy_results[policy_id]
+
+        policy_CVaR = 340000000*policy_ICUover_CVaR.value()
+        max_P_ICU_overload = policy_ICU_overloads.max_probability()
+        risk_results[policy_id] = {'ICUOL (CVaR 10%)': float(policy_CVaR), 'max ICUOL P': float(max_P_ICU_overload),
+                                   'samples': int(policy_ICU_overloads.samples)}
+
+        # sample results (columns 'Deaths', 'Output' and 'ICU overload') are saved as a shard of the run's sample
+        # store, and the results of completed policies to the risk results file, before the policy is marked
+        # completed
+        sample_store.add(policy_id, np.concatenate(policy_result_dist))
+        sample_store.save_policy(store_path, policy_id)
+        write_risk_results(run_results_df, risk_results, risk_path)
+        manifest.add(run, policy_id, risk_results[policy_id])
         bar.next()
 
-    # get full results:
-
-    full_results = run_results_df.copy()
+    if pool != None:
+        pool.close()
+        pool.join()
 
-    loc = len(full_results.columns)
-    full_results.insert(loc, 'ICUOL (CVaR 10%)', policy_CVaRs)
-    full_results.insert(loc+1, 'max ICUOL P', policy_ICUOL_Ps)
-    full_results.to_csv('active_results/risk_analysis/'+run+'_' + set_id + '_risk' + file_suffix +'.csv')
+    # get full results:
 
+    sample_store.save(store_path)
+    write_risk_results(run_results_df, risk_results, risk_path)
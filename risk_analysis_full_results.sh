@@ -1,6 +1,6 @@
 #!/bin/bash
 #SBATCH --time=60:00:00
-#SBATCH --mem-per-cpu=110M
+#SBATCH --mem-per-cpu=600M
 #SBATCH --array=0-80
 
 module restore covid_opt
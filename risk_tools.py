@@ -0,0 +1,437 @@
+#### Tools for risk analysis results (see risk_analysis.py)
+# Storing per sample results of all policies of a run in one columnar file, and reading selected
+# columns and policies from it. Streaming risk measures, parameter sampling, the parameter sample bank and
+# simulation of (policy, sample batch) work units.
+
+import os
+import hashlib
+import heapq
+import json
+import shutil
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from math import floor
+from collections import deque
+
+from run_tools import create_epidemic_model
+
+
+def risk_store_path(run, set_id, file_suffix=''):
+    # sample result store of a run, saved next to the run's '_risk.csv' summary
+    return 'active_results/risk_analysis/' + run + '_' + set_id + '_samples' + file_suffix + '.npz'
+
+
+def risk_manifest_path(run, set_id, file_suffix=''):
+    # manifest of the completed policies of a run, used to resume interrupted risk analysis jobs
+    return 'active_results/risk_analysis/' + run + '_' + set_id + '_manifest' + file_suffix + '.jsonl'
+
+
+def sample_bank_path(sampler, seed, sample_size):
+    # default sample bank of a sampler and seed, shared by all runs analysed with them. Latin hypercube samples depend
+    # on the sample size, so 'lhs' banks are per sample size too.
+    size_suffix = '_' + str(sample_size) if sampler == 'lhs' else ''
+    return 'active_results/risk_analysis/sample_bank_' + sampler + '_' + str(seed) + size_suffix + '.npy'
+
+
+class RiskSampleStore():
+    # Per sample results of the policies of one risk analysis run, in columnar form: the parameter samples (one value
+    # per sample, shared by all policies) and, for each result column, a (policies, samples) array. Results are keyed
+    # by (policy_id, sample_id), where sample_id is the index of the sample. Saved as one npz bundle with one array
+    # per column, so that readers can load only the columns they need. Policies simulated with fewer samples than
+    # others (adaptive sample size) have NaN results for the remaining samples, and their sample counts are saved.
+    # While a run is in progress, the results of each completed policy are saved as a shard of their own (see
+    # save_policy) and merged into the bundle once, by save.
+
+    result_columns = ['Deaths', 'Output', 'ICU overload']
+
+    def __init__(self, param_values, sample_bank=''):
+        self.param_values = param_values # dictionary: parameter name -> array of sample values
+        self.sample_bank = sample_bank # sample bank the parameter samples were read from, sample_id = bank index
+        self.results = {} # dictionary: policy id -> (samples, len(result_columns)) array
+
+    def add(self, policy_id, results):
+        # results: (samples, len(result_columns)) array of the policy's sample results
+        self.results[policy_id] = np.asarray(results)
+
+    def restore(self, path, policies):
+        # adds the results of the given policies from a saved store and its shards, e.g. when resuming an interrupted
+        # run
+        sharded = [policy_id for policy_id in policies if os.path.exists(self.shard_path(path, policy_id))]
+        for policy_id in sharded:
+            self.add(policy_id, np.load(self.shard_path(path, policy_id)))
+
+        merged = [policy_id for policy_id in policies if policy_id not in sharded]
+        if len(merged) > 0:
+            saved = load_risk_samples(path, self.result_columns, merged)
+            for i, policy_id in enumerate(merged):
+                results = np.column_stack([saved[column][i] for column in self.result_columns])
+                self.add(policy_id, results[:saved['sample_count'][i]])
+
+    @staticmethod
+    def shard_path(path, policy_id):
+        return os.path.join(path + '.shards', str(policy_id) + '.npy')
+
+    def save_policy(self, path, policy_id):
+        # saves the results of one policy as a shard next to the store at path, so that saving the policies of a run
+        # one by one takes time linear in their number
+        shard = self.shard_path(path, policy_id)
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        with open(shard + '.tmp', 'wb') as f:
+            np.save(f, self.results[policy_id])
+        os.replace(shard + '.tmp', shard)
+
+    def save(self, path):
+        # saves all results as one bundle, the shards merged into it are removed
+        policy_ids = sorted(self.results) # rows in policy order
+        sample_counts = np.array([len(self.results[policy_id]) for policy_id in policy_ids], dtype=int)
+        n_samples = max([len(values) for values in self.param_values.values()] + list(sample_counts))
+        arrays = {'policy_id': np.array(policy_ids),
+                  'sample_id': np.arange(n_samples),
+                  'sample_count': sample_counts,
+                  'sample_bank': np.array(self.sample_bank, dtype=str),
+                  'params': np.array(list(self.param_values.keys()), dtype=str)}
+        arrays.update({'param_' + p: np.asarray(values) for p, values in self.param_values.items()})
+        for i, column in enumerate(self.result_columns):
+            column_results = np.full((len(policy_ids), n_samples), np.nan)
+            for row, policy_id in enumerate(policy_ids):
+                column_results[row, :sample_counts[row]] = self.results[policy_id][:, i]
+            arrays['result_' + column] = column_results
+
+        # written to a temporary file first, so that an interrupted save does not leave a broken store behind
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path + '.tmp', path)
+        shutil.rmtree(path + '.shards', ignore_errors=True)
+
+
+def load_risk_samples(path, columns=None, policies=None):
+    # loads sample results from a store. columns: result columns to load (default: all), policies: policy ids to
+    # load (default: all). Returns a dictionary with 'policy_id', 'sample_count' and a (policies, samples) array for
+    # each column.
+    with np.load(path) as store:
+        policy_ids = store['policy_id']
+        if columns is None:
+            columns = [key[len('result_'):] for key in store.files if key.startswith('result_')]
+
+        if policies is None:
+            rows = slice(None)
+        else:
+            position = {policy_id: i for i, policy_id in enumerate(policy_ids)}
+            rows = [position[policy_id] for policy_id in policies]
+
+        results = {'policy_id': policy_ids[rows], 'sample_count': store['sample_count'][rows]}
+        for column in columns:
+            results[column] = store['result_' + column][rows]
+
+    return results
+
+
+def load_risk_params(path, params=None):
+    # loads the parameter samples of a store as a DataFrame with one row per sample (default: all parameters)
+    with np.load(path) as store:
+        if params is None:
+            params = list(store['params'])
+        return pd.DataFrame({p: store['param_' + p] for p in params}, index=store['sample_id'])
+
+
+def risk_sample_frame(path, policy_id, columns=None, params=None):
+    # sample results of one policy as a DataFrame with parameter columns followed by result columns and one row
+    # per sample, i.e. the layout of the per policy csv files of earlier versions. Only the samples simulated for the
+    # policy are included.
+    df = load_risk_params(path, params)
+    results = load_risk_samples(path, columns, [policy_id])
+    for column in results:
+        if column not in ('policy_id', 'sample_count'):
+            df[column] = results[column][0]
+
+    return df.iloc[:results['sample_count'][0]]
+
+
+class StreamingCVaR():
+    # CVaR -type 'worst case' expectation value for event mass alpha, updated one sample at a time. Only the
+    # alpha_N + 1 worst values seen so far are kept (in a bounded heap), alpha_N = floor(sample_size*alpha), so memory
+    # does not grow with the sample size. Gives the same value as sorting the full sample: average of the alpha_N
+    # worst values plus the fractional remainder taken from the next worst one.
+    # sample_size is the largest number of samples to be added, the value is computed from the samples added so far.
+    # lowest_alpha controls if the alpha share is selected from the low end (or the high end) of sample.
+
+    def __init__(self, sample_size, alpha, lowest_alpha=True):
+        self.alpha = alpha
+        self.sign = -1.0 if lowest_alpha else 1.0 # heap keys: the largest keys are the worst values
+        self.k = min(floor(sample_size*alpha) + 1, sample_size)
+        self.heap = []
+        self.samples = 0
+
+    def add(self, values):
+        for value in np.asarray(values, dtype=float).ravel():
+            key = self.sign * value
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, key)
+            elif key > self.heap[0]:
+                heapq.heapreplace(self.heap, key)
+            self.samples += 1
+
+    def _tail(self):
+        # the alpha_N worst values of the samples added so far, in the same order as in a sorted sample, and the next
+        # worst value (None if all samples are in the alpha share)
+        alpha_N = floor(self.samples*self.alpha) # number of cases corresponding to share alpha
+        worst = [self.sign * key for key in sorted(self.heap)[-(alpha_N + 1):]]
+        if len(worst) > alpha_N:
+            return worst[1:], worst[0]
+        return worst, None
+
+    def value(self):
+        worst_alpha, next_worst = self._tail()
+        remainder = (self.samples*self.alpha - len(worst_alpha))*next_worst if next_worst is not None else 0.0
+
+        return (sum(worst_alpha)+remainder)/(self.samples*self.alpha)
+
+    def interval(self, z):
+        # normal approximation confidence interval (value - z*se, value + z*se) of the CVaR. The standard error uses
+        # the asymptotic variance of the CVaR estimator, Var((X - VaR)^+)/alpha^2, where only the alpha share worst
+        # values exceed VaR.
+        cvar = self.value()
+        worst_alpha, next_worst = self._tail()
+        if next_worst is None:
+            return cvar, cvar
+        excess = self.sign * (np.array(worst_alpha) - next_worst)
+        variance = np.sum(excess**2)/self.samples - (np.sum(excess)/self.samples)**2
+        half_width = z * np.sqrt(max(variance, 0.0)/self.samples) / self.alpha
+
+        return cvar - half_width, cvar + half_width
+
+
+class OverloadCounter():
+    # counts, for each time step of the results, the number of samples with ICU overload. Memory is one int32 counter
+    # per time step. The counters are created on the first update, from the number of time steps in the results.
+
+    def __init__(self):
+        self.counts = None
+        self.samples = 0
+
+    def add(self, overloaded):
+        # overloaded: (samples, time steps) boolean array
+        if self.counts is None:
+            self.counts = np.zeros(overloaded.shape[1], dtype=np.int32)
+        self.counts += np.count_nonzero(overloaded, axis=0).astype(np.int32)
+        self.samples += overloaded.shape[0]
+
+    def max_probability(self):
+        # highest share of overloaded samples over time steps
+        return self.counts.max() / self.samples
+
+    def interval(self, z):
+        # Wilson score confidence interval of the overload probability at the time step of highest probability
+        p = self.max_probability()
+        n = self.samples
+        center = (p + z**2/(2*n)) / (1 + z**2/n)
+        half_width = z * np.sqrt(p*(1 - p)/n + z**2/(4*n**2)) / (1 + z**2/n)
+
+        return center - half_width, center + half_width
+
+
+def classify_risk(interval, threshold):
+    # classifies a risk measure against a threshold from its confidence interval: 1 if confidently above the
+    # threshold, -1 if confidently below and 0 if the interval contains the threshold
+    if interval[0] > threshold:
+        return 1
+    if interval[1] < threshold:
+        return -1
+    return 0
+
+
+def unit_samples(sampler, sample_size, dimensions, rng):
+    # (sample_size, dimensions) array of points in the unit cube, mapped to parameter samples through inverse CDFs.
+    # sampler: 'lhs' for Latin hypercube sampling, 'sobol' for scrambled Sobol sequence (needs scipy >= 1.7).
+    # rng: numpy random Generator used for the randomization, so that the samples are fixed by its seed.
+    if sampler == 'lhs':
+        # one point in each of the sample_size equal width strata of each dimension, strata in random order
+        strata = np.array([rng.permutation(sample_size) for d in range(dimensions)]).T
+        return (strata + rng.uniform(size=(sample_size, dimensions))) / sample_size
+
+    if sampler == 'sobol':
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ImportError("Sobol sampling needs scipy.stats.qmc (scipy >= 1.7)")
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # balance warning for sample sizes other than powers of 2
+            return qmc.Sobol(dimensions, scramble=True, seed=rng).random(sample_size)
+
+    raise ValueError("unknown sampler: " + str(sampler))
+
+
+#### Parameter sample bank
+# Parameter samples saved once as a (samples, parameters) array in a .npy file, with the sampling definitions
+# (parameters, distributions, sampler, seed) in a json file next to it. All runs and policies read the same samples
+# by sample index, from the memory mapped file, so that results of different runs and policies are computed with
+# common random numbers and can be compared sample by sample.
+
+def save_sample_bank(path, samples, metadata, prefix_samples=True):
+    # samples: (samples, parameters) array, metadata: dictionary of sampling definitions, incl. 'params', the
+    # parameter names in column order. prefix_samples: as in load_sample_bank. Such banks are only extended: if a bank
+    # with the same definitions and at least as many samples exists (e.g. saved by a parallel job meanwhile), it is
+    # kept. Returns True if the samples were saved.
+    if prefix_samples and load_sample_bank(path, metadata, len(samples)) is not None:
+        return False
+    samples = np.ascontiguousarray(samples, dtype=float)
+    metadata = dict(metadata, sample_size=len(samples), checksum=hashlib.sha1(samples.tobytes()).hexdigest())
+
+    # written to temporary files of this process first and then renamed, the metadata last. The metadata holds a
+    # checksum of the samples, so that samples of one job are never read with the metadata of another job writing
+    # the bank at the same time.
+    directory = os.path.dirname(path) or '.'
+    fd, samples_tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, samples)
+    fd, metadata_tmp = tempfile.mkstemp(dir=directory, suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(samples_tmp, path)
+    os.replace(metadata_tmp, path + '.json')
+    return True
+
+
+def load_sample_bank(path, metadata, sample_size, prefix_samples=True):
+    # memory maps the first sample_size samples of a bank, if the bank exists, has the same sampling definitions
+    # and has enough samples. Returns None otherwise. prefix_samples: True if the first samples of a larger bank
+    # are valid samples (False e.g. for Latin hypercube, where the bank must have exactly sample_size samples).
+    try:
+        with open(path + '.json') as f:
+            bank_metadata = json.load(f)
+        samples = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    bank_size = bank_metadata.pop('sample_size', len(samples))
+    checksum = bank_metadata.pop('checksum', None) # not in banks of earlier versions
+    if bank_metadata != json.loads(json.dumps(metadata)) or len(samples) != bank_size:
+        return None
+    if checksum is not None and checksum != hashlib.sha1(np.ascontiguousarray(samples).tobytes()).hexdigest():
+        return None # samples and metadata of different writes
+    if bank_size < sample_size or (not prefix_samples and bank_size != sample_size):
+        return None
+
+    return samples[:sample_size]
+
+
+class RiskManifest():
+    # Completed (run, policy_id) units of a risk analysis job with their risk results, for resuming interrupted jobs.
+    # Saved as a json lines file: the first line holds the job settings, then one line is appended per completed
+    # unit. A manifest with other settings than the current job (or a missing one) is started over, and a partly
+    # written last line of an interrupted job is ignored.
+
+    def __init__(self, path, settings, restart=False):
+        self.path = path
+        self.completed = {} # dictionary: (run, policy id) -> dictionary of risk results
+
+        settings = json.loads(json.dumps(settings))
+        lines = []
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        lines.append(json.loads(line))
+                    except ValueError:
+                        break
+
+        if len(lines) > 0 and lines[0] == {'settings': settings}:
+            for unit in lines[1:]:
+                self.completed[(unit['run'], unit['policy_id'])] = unit['results']
+            # rewritten without a possibly broken last line
+            self._write(lines)
+        else:
+            self._write([{'settings': settings}])
+
+    def _write(self, lines):
+        with open(self.path + '.tmp', 'w') as f:
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+    def add(self, run, policy_id, results):
+        # records a completed unit, results: dictionary of the unit's risk results
+        self.completed[(run, policy_id)] = results
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'run': run, 'policy_id': policy_id, 'results': results}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+#### Simulation of (policy, sample batch) work units
+# The sample-batched epidemic models of a run are created once per process by init_risk_worker (in each worker of a
+# process pool, or in the main process), and simulate_risk_batch simulates one sample batch with one policy.
+
+_risk_worker = {}
+
+def init_risk_worker(run_params, param_arrays, batch_size, p_ICU, C_hos, T_rec):
+    # run_params: run definition, param_arrays: dictionary of parameter sample arrays, batch_size: number of samples
+    # simulated together
+    sample_size = len(next(iter(param_arrays.values())))
+
+    # sample-batched epidemic models: each one simulates batch_size parameter samples together. The same
+    # models are used for all policies of the run.
+    sample_simulators = []
+    for batch_start in range(0, sample_size, batch_size):
+        sample_run_params = run_params.copy() # copies the original run (e.g. 'romer') for updating with sample values
+        sample_run_params.update({p: values[batch_start:batch_start + batch_size] for p, values in param_arrays.items()})
+        sample_simulators.append(create_epidemic_model(**sample_run_params))
+
+    _risk_worker.clear()
+    _risk_worker.update(sample_simulators=sample_simulators, p_ICU=p_ICU, C_hos=C_hos, T_rec=T_rec, schedule=(None, None))
+
+def simulate_risk_batch(unit):
+    # unit: (policy_id, policy, batch index). Returns (policy_id, batch index, (batch samples, 3) array of the
+    # sample results 'Deaths', 'Output' and 'ICU overload', (batch samples, days) boolean array of ICU overload)
+    policy_id, run_policy, batch = unit
+    sample_simulators = _risk_worker['sample_simulators']
+    p_ICU, C_hos, T_rec = _risk_worker['p_ICU'], _risk_worker['C_hos'], _risk_worker['T_rec']
+    T_rec_t = int(round(14 * 365 * T_rec))  # change from years to time steps
+
+    # the policy is compiled into per time step values once and the schedule is reused for all sample batches
+    if _risk_worker['schedule'][0] != policy_id:
+        run_schedule = sample_simulators[0][0].compile_policy(sample_simulators[0][1], run_policy)
+        _risk_worker['schedule'] = (policy_id, run_schedule)
+    run_schedule = _risk_worker['schedule'][1]
+
+    epidemic_simulator = sample_simulators[batch]
+
+    # calculate results for a batch of samples, row i of each output corresponds to sample i of the batch
+
+    result = epidemic_simulator[0].solve_case_samples(epidemic_simulator[1], run_schedule)
+    Symptomatic_T, Dead_D, Y_D, Y_total = result.Symptomatic_D, result.Dead_D, result.Y_D, result.Y_total
+
+    # calculating aggregated ICU capacity overload:
+
+    ICU_use_T = p_ICU * Symptomatic_T
+    ICU_margin_T = ICU_use_T - (C_hos / epidemic_simulator[0].pop)
+    ICU_overuse_T = np.maximum(ICU_margin_T, 0.0) # this has non-zero values for overuse, 0 otherw.
+    ICU_overuse_agg = np.sum(ICU_overuse_T, axis=1)
+
+    # Costs:
+    cost_e = -Y_total / epidemic_simulator[0].T  # contains loss of output & scaled direct costs
+    cost_terminal = ((T_rec_t) / 2) * (-Y_D[:, -1]) / epidemic_simulator[0].T
+    deaths_terminal = ((T_rec_t) / 2) * ((Dead_D[:, -1] - Dead_D[:,
+        -2]) * epidemic_simulator[0].pop / 1000) / epidemic_simulator[0].T  # Deaths are cumulative, so difference needed for current rate
+
+    # objectives scaled in same way as in optimizer objective calculation!
+    scaling = epidemic_simulator[0].T_years / (T_rec/2 + epidemic_simulator[0].T_years)
+    deaths_norm_adj = Dead_D[:, -1] * epidemic_simulator[0].pop / 1000 + deaths_terminal
+    output_norm_adj = scaling * (cost_e + cost_terminal)
+
+    return policy_id, batch, np.column_stack([deaths_norm_adj, output_norm_adj, ICU_overuse_agg]), ICU_overuse_T > 0
+
+
+def imap_bounded(pool, function, units, max_pending):
+    # results of function for units, in order, like pool.imap. A unit is taken from the units iterator only when
+    # fewer than max_pending units are in progress, so that the iterator can skip units based on the results of
+    # earlier ones (pool.imap reads the whole iterator ahead).
+    pending = deque()
+    for unit in units:
+        pending.append(pool.apply_async(function, (unit,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
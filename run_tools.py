@@ -8,10 +8,18 @@
 
 import numpy as np
 import pandas as pd
-from policy_epidemic_model_code import optimizable_corona_model
+import hashlib
+import inspect
+import json
+import os
+import re
+from collections import OrderedDict
+from collections.abc import Mapping
+from multiprocessing import Pool
+from policy_epidemic_model_code import optimizable_corona_model, SimulationResult
 
 from run_definitions import *
-from kMedoids_clustering import GetSwitch, GetCluster, CalcPearson, GetInitialMedoids, kMedoids
+from kMedoids_clustering import GetSwitch, GetCluster, CalcPearson, GetInitialMedoids, kMedoids, CLARA
 
 class Policy_template():
 
@@ -60,10 +68,12 @@ def create_epidemic_model(ksi_base=ksi_base_default,
                negative_q_rate=negative_q_rate_default,
                positive_q_rate=positive_q_rate_default,
                testing_cost=testing_cost_default,
+               prefix_nodes=0, # max size of the trie for reusing histories of solved policies, 0 for no reuse
                **kwargs):
 
     model = optimizable_corona_model(ksi_base, A_rel, r_AP, d_vaccine, rel_rho, delta_param, \
                                      omegaR_param, pii_D, R_0, lambda_param, rel_lambda_param, initial_infect, testing_cost, eta, gamma_param)
+    model.set_prefix_reuse(prefix_nodes)
 
     model_case = {
         'tau_paramA': (1 + daily_testing_rate) ** (1. / model.Delta_time) - 1,
@@ -85,6 +95,99 @@ def create_epidemic_model(ksi_base=ksi_base_default,
     return model, model_case
 
 
+def solve_objective_outputs(model, model_case, X, lockdown_policy_control_days, testing_policy_control_days):
+    # solves the policies in decision matrix X (see optimizable_corona_model.solve_case_batch) and returns only the
+    # outputs needed for optimization objectives and constraints: Dead_D, Dead_T, Y_D, Y_total and daily tests.
+    # Uses the lean solver unless histories of solved policies are stored for prefix reuse (needs full outputs).
+    if model.prefix_trie is None:
+        return model.solve_objectives_batch(model_case, X, lockdown_policy_control_days, testing_policy_control_days)
+
+    result = model.solve_case_batch(model_case, X, lockdown_policy_control_days, testing_policy_control_days)
+
+    return result.Dead_D, result.Dead_T, result.Y_D, result.Y_total, result.tests
+
+
+# Parallel evaluation: each worker process creates its epidemic model once, when the pool is started
+_worker_simulator = None
+
+def _init_worker_simulator(epidemic_model_params):
+    global _worker_simulator
+    _worker_simulator = create_epidemic_model(**epidemic_model_params)
+
+def _solve_objective_outputs_worker(X, lockdown_policy_control_days, testing_policy_control_days):
+    model, model_case = _worker_simulator
+    return solve_objective_outputs(model, model_case, X, lockdown_policy_control_days, testing_policy_control_days)
+
+class ParallelSolver():
+    # Persistent pool of worker processes with the epidemic model defined by epidemic_model_params (arguments of
+    # create_epidemic_model) preloaded. Policies (rows of the decision matrix) are solved independently of each other,
+    # so the results are identical to solving them in one process.
+
+    def __init__(self, workers, epidemic_model_params):
+        self.workers = workers
+        self.pool = Pool(workers, initializer=_init_worker_simulator, initargs=(epidemic_model_params,))
+
+    def solve_objective_outputs(self, X, lockdown_policy_control_days, testing_policy_control_days):
+        # same as solve_objective_outputs, X is split into one block of rows per worker
+        blocks = [block for block in np.array_split(X, self.workers) if len(block) > 0]
+        results = self.pool.starmap(_solve_objective_outputs_worker,
+                                    [(block, lockdown_policy_control_days, testing_policy_control_days)
+                                     for block in blocks])
+
+        return tuple(np.concatenate(output) for output in zip(*results))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def run_parameters_hash(run_parameters):
+    # hash of a dictionary of run parameters (numbers, strings and lists of them), identifies the run in caches.
+    # Values are encoded as json, other objects by their str, so leave out objects without a stable str (see
+    # simulation_parameters).
+    return hashlib.sha1(json.dumps(run_parameters, sort_keys=True, default=str).encode()).hexdigest()
+
+def simulation_parameters(run_parameters):
+    # the run parameters the simulation results depend on: the arguments of create_epidemic_model (model and model
+    # case), with defaults filled in. Optimizer settings such as limits or pymoo operators are left out.
+    arguments = inspect.signature(create_epidemic_model).parameters
+    return {name: run_parameters.get(name, arguments[name].default) for name in arguments
+            if name != 'prefix_nodes' and arguments[name].kind != inspect.Parameter.VAR_KEYWORD}
+
+class EvaluationCache():
+    # Bounded least recently used cache for objective (F) and constraint (G) values of evaluated decision vectors.
+    # Keys consist of a run parameter hash and the decision vector quantised to steps of resolution * variable range,
+    # so repeated and near duplicate individuals are not simulated again.
+
+    def __init__(self, max_size, resolution=1e-6):
+        self.max_size = max_size
+        self.resolution = resolution
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, params_hash, X, xl, xu):
+        # fixed variables (xu == xl) are quantised with a range of 1
+        width = np.where(xu > xl, xu - xl, 1.0)
+        steps = np.rint((X - xl) / (width * self.resolution)).astype(np.int64)
+        return [(params_hash, row.tobytes()) for row in steps]
+
+    def get(self, key):
+        # returns cached (F, G) rows or None
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, F, G):
+        # copies, as F and G are often rows of arrays handed on to the optimizer
+        self.entries[key] = (np.array(F), np.array(G))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)  # least recently used
+
 def create_policy_control(lockdown_policy_control_days=[1, 15, 30, 60, 90, 120, 150, 200, 250, 300, 350, 400, 450, 500, 600],
                     lockdown_policy_lower_limits=list(0.5 * np.ones(15)),
                     # can't use len(l_p_c_d) within function param def
@@ -185,14 +288,105 @@ def create_policy(lockdown_policy, testing_policy):
 
     return Policy(lockdown_policy, testing_policy)
 
+# policy column names of result files, e.g. "('ld', 30)" for lockdown at day 30, parsed without evaluating them
+_policy_column_pattern = re.compile(r"^\(\s*'(\w+)'\s*,\s*(-?\d+)\s*\)$")
+
+class PolicySchema():
+    # Policy columns of a result file: for each policy column its name, control type ('ld' or 'test') and control day.
+    # Read from a json sidecar file saved next to the result file (see save_policy_schema) or, for result files without
+    # one, parsed from column names like "('ld', 30)". Other columns (objectives, cluster, ...) are not included.
+
+    def __init__(self, columns, types, days):
+        self.columns = list(columns)
+        self.types = np.array(types, dtype=str)
+        self.days = np.array(days, dtype=int)
+
+    def type_columns(self, policy_type):
+        # names of the policy columns of a control type
+        return [c for c, t in zip(self.columns, self.types) if t == policy_type]
+
+    def control_days(self, policy_type):
+        # control days of a control type, in column order
+        return [int(d) for d in self.days[self.types == policy_type]]
+
+    def values(self, df, policy_type=None):
+        # (policies, controls) array of the policy values in df, of one control type or all policy columns
+        columns = self.columns if policy_type is None else self.type_columns(policy_type)
+        return df[columns].to_numpy(dtype=float)
+
+    def tuples(self):
+        # (type, day) tuples of the policy columns
+        return [(t, int(d)) for t, d in zip(self.types, self.days)]
+
+    def type_masks(self):
+        # dictionary: control type -> boolean mask of its policy columns
+        return {t: self.types == t for t in np.unique(self.types)}
+
+def scale_policy_types(policies, schema, ranges=None):
+    # scales the values of each control type in the (policies, policy columns) float array to range [0, 1] in place,
+    # using the (min, max) ranges of the types given in ranges, or the ranges of the values (NaNs ignored) if not
+    # given. Types with equal min and max are only shifted. Returns the ranges used, so that the same scaling can be
+    # applied to other policies.
+    if ranges is None:
+        ranges = {}
+    for t, mask in schema.type_masks().items():
+        if t not in ranges:
+            ranges[t] = (np.nanmin(policies[:, mask]), np.nanmax(policies[:, mask]))
+        min_val, max_val = ranges[t]
+        type_values = policies[:, mask]
+        type_values -= min_val
+        if max_val > min_val:
+            type_values /= (max_val - min_val)
+        policies[:, mask] = type_values
+
+    return ranges
+
+def parse_policy_columns(columns):
+    # PolicySchema from column names like "('ld', 30)" or (type, day) tuples, other columns are skipped
+    names, types, days = [], [], []
+    for c in columns:
+        if isinstance(c, tuple) and len(c) == 2:
+            policy_type, day = c
+        else:
+            match = _policy_column_pattern.match(str(c))
+            if match is None:
+                continue
+            policy_type, day = match.groups()
+        names.append(c)
+        types.append(policy_type)
+        days.append(int(day))
+
+    return PolicySchema(names, types, days)
+
+def policy_schema_path(csv_path):
+    return csv_path + '.schema.json'
+
+def save_policy_schema(csv_path, schema):
+    # saves the policy columns of a result file to a json sidecar file next to it
+    with open(policy_schema_path(csv_path), 'w') as f:
+        json.dump({'columns': [{'name': str(c), 'type': str(t), 'day': int(d)}
+                               for c, t, d in zip(schema.columns, schema.types, schema.days)]}, f, indent=1)
+
+def read_policy_schema(csv_path, columns):
+    # PolicySchema of the given columns of a result file, from its sidecar file if there is one, otherwise parsed
+    # from the column names
+    try:
+        with open(policy_schema_path(csv_path)) as f:
+            saved = {entry['name']: entry for entry in json.load(f)['columns']}
+    except (OSError, ValueError, KeyError):
+        return parse_policy_columns(columns)
+
+    policy_columns = [c for c in columns if c in saved]
+    return PolicySchema(policy_columns, [saved[c]['type'] for c in policy_columns],
+                        [saved[c]['day'] for c in policy_columns])
+
 def construct_policy(run_info, run_policies_df, policy_index):
 
-    test_cols = [tup for tup in run_policies_df.columns if eval(tup)[0] == 'test']
-    ld_cols = [tup for tup in run_policies_df.columns if eval(tup)[0] == 'ld']
-    ld_control_times = list(map(int, [eval(tup)[1] for tup in run_policies_df.columns if eval(tup)[0] == 'ld']))
-    test_control_times = list(map(int, [eval(tup)[1] for tup in run_policies_df.columns if eval(tup)[0] == 'test']))
-    policy_ld = run_policies_df[ld_cols].loc[policy_index].to_numpy()
-    policy_test = run_policies_df[test_cols].loc[policy_index].to_numpy()
+    schema = parse_policy_columns(run_policies_df.columns)
+    ld_control_times = schema.control_days('ld')
+    test_control_times = schema.control_days('test')
+    policy_ld = run_policies_df.loc[policy_index, schema.type_columns('ld')].to_numpy()
+    policy_test = run_policies_df.loc[policy_index, schema.type_columns('test')].to_numpy()
 
     try:
         lockdown_only = (run_info['testing_policy_control_days'] == 'NA')
@@ -223,24 +417,23 @@ def construct_policy(run_info, run_policies_df, policy_index):
 
     return run_policy
 
-def cluster_run(run_policies_df, n_clusters, scale_types=True, grouping=None):
+def cluster_run(run_policies_df, n_clusters, scale_types=True, grouping=None, sampling=False, n_samples=5,
+                sample_size=None, seed=None):
     #run_control_times = list(map(int, run_policies_df.columns))
+    # sampling: if True, clusters samples of policies (CLARA, see kMedoids_clustering) instead of all policies, for
+    # large sets of policies. n_samples, sample_size: number and size of samples, seed: seed of sample selection.
+
+    # policy values as a float array (a copy, run_policies_df is not changed)
+    schema = parse_policy_columns(run_policies_df.columns)
+    run_policies = schema.values(run_policies_df)
 
     # scaling of different policy types to common range [0,1]
-    run_policies_df.columns = [eval(c) for c in run_policies_df.columns]
-    policy_types = np.unique([c[0] for c in run_policies_df.columns])
     if scale_types:
-        max_val = {}
-        min_val = {}
-
-        for t in policy_types:
-            col_list = [c for c in run_policies_df.columns if c[0]==t]
-            max_val[t] = np.amax(run_policies_df[col_list].to_numpy())
-            min_val[t] = np.amin(run_policies_df[col_list].to_numpy())
-
-            run_policies_df[col_list].apply(lambda x: (x - min_val[t]) / (max_val[t] - min_val[t]))
+        scale_policy_types(run_policies, schema)
 
-    run_policies = run_policies_df.to_numpy()
+    if sampling:
+        return CLARA(n_clusters, run_policies, n_samples=n_samples, sample_size=sample_size, nan_to_large_dist=True,
+                     grouping=grouping, seed=seed)
 
     corr, dist = CalcPearson(run_policies, nan_to_large_dist=True, grouping=grouping)
     #print("dist: ", dist)
@@ -258,6 +451,8 @@ def collect_results(runs, save_csv=False):
 
         if save_csv:
             full_results.to_csv('active_results/' + run + '_full_results' + '.csv')
+            save_policy_schema('active_results/' + run + '_full_results' + '.csv',
+                               parse_policy_columns(full_results.columns))
 
         full_results_all[run] = full_results
 
@@ -274,11 +469,99 @@ def extract_selected(runs, df, selected, save_csv=False, csv_identifier='selecte
 
         if save_csv:
             selected_res.to_csv('active_results/' + run + '_' + csv_identifier + '.csv')
+            save_policy_schema('active_results/' + run + '_' + csv_identifier + '.csv',
+                               parse_policy_columns(selected_res.columns))
 
     return selected_solutions
 
 
-def simulate_solutions(run_list, result_set='full_results', no_control_runs=[], policy_set=[]):
+class SimulationCache():
+    # On-disk cache of re-simulated policies. Each entry is keyed by the hash of the simulation parameters of the run
+    # (see simulation_parameters) and the hash of the policy (control days and values) and consists of the data array
+    # of its SimulationResult (<key>.npy) and the rates needed to derive its outputs (<key>_rates.npz). Data files are
+    # memory mapped on load, so cached results take no memory until their outputs are used. The model code is not
+    # part of the key: clear the directory after changing the model.
+
+    rate_names = ['tau', 'tau_TT', 'test_sens', 'test_spec', 'delta', 'pop', 'test_cost']
+
+    def __init__(self, directory='active_results/simulation_cache'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, run_hash, policy_values, lockdown_policy_control_days, testing_policy_control_days):
+        policy_hash = hashlib.sha1(repr((list(lockdown_policy_control_days), list(testing_policy_control_days))).encode())
+        policy_hash.update(np.ascontiguousarray(policy_values, dtype=np.float64).tobytes())
+        return run_hash + '_' + policy_hash.hexdigest()
+
+    def data_path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def rates_path(self, key):
+        return os.path.join(self.directory, key + '_rates.npz')
+
+    def __contains__(self, key):
+        # the rates are written last, so an entry is complete once they exist
+        return os.path.exists(self.rates_path(key))
+
+    def save(self, key, result):
+        # result: single row SimulationResult, written atomically (see save_policy_schema)
+        with open(self.data_path(key) + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(result.data))
+        os.replace(self.data_path(key) + '.tmp', self.data_path(key))
+        with open(self.rates_path(key) + '.tmp', 'wb') as f:
+            np.savez(f, **{name: getattr(result, name) for name in self.rate_names})
+        os.replace(self.rates_path(key) + '.tmp', self.rates_path(key))
+
+    def load(self, key):
+        with np.load(self.rates_path(key)) as rates:
+            rate_values = {name: rates[name][()] for name in self.rate_names}
+        return SimulationResult(np.load(self.data_path(key), mmap_mode='r'), **rate_values)
+
+class LazySimulationResults(Mapping):
+    # read only dictionary of policy number -> SimulationResult, loading each result from the cache when first used
+
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys_ = keys # policy number -> cache key
+        self.loaded = {}
+
+    def __getitem__(self, pol_no):
+        if pol_no not in self.loaded:
+            self.loaded[pol_no] = self.cache.load(self.keys_[pol_no])
+        return self.loaded[pol_no]
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+def _init_worker_simu_run(run_parameters, prefix_nodes, cache_dir):
+    global _worker_simu_run
+    model, model_case, _ = create_simu_run(**run_parameters)
+    model.set_prefix_reuse(prefix_nodes)
+    _worker_simu_run = (model, model_case, SimulationCache(cache_dir))
+
+def simulate_to_cache(model, model_case, cache, X, keys, lockdown_policy_control_days, testing_policy_control_days):
+    # solves the rows of the decision matrix X (see solve_case_batch) and saves row n in cache under keys[n]
+    result = model.solve_case_batch(model_case, X, lockdown_policy_control_days, testing_policy_control_days)
+    for n, key in enumerate(keys):
+        cache.save(key, result.row(n))
+    return keys
+
+def _simulate_to_cache_worker(X, keys, lockdown_policy_control_days, testing_policy_control_days):
+    # only the keys are sent back, the results are read from the cache
+    model, model_case, cache = _worker_simu_run
+    return simulate_to_cache(model, model_case, cache, X, keys, lockdown_policy_control_days,
+                             testing_policy_control_days)
+
+def simulate_solutions(run_list, result_set='full_results', no_control_runs=[], policy_set=[], prefix_nodes=0,
+                       workers=1, batch_size=20, cache_dir='active_results/simulation_cache'):
+    # Policies are simulated in batches of batch_size, in parallel when workers > 1, and written to a SimulationCache
+    # in cache_dir. Policies found in the cache are not simulated again. policy_sim_data[run] is a
+    # LazySimulationResults, reading the results from the cache when first used.
+    # prefix_nodes: size of the trie used for resuming policies from common early parts of earlier solved policies,
+    # 0 for no reuse. Memory use grows with it, see optimizable_corona_model.set_prefix_reuse.
     policies = {}  # library to hold policy values, organized by: run, policy_number, policy values
     policy_obj_values = {}  # library to hold objective values, organized by: run, policy_number, objective values
     policy_sim_data = {}  # library to hold simulation output, organized by: run, policy_number, output_id, output_values
@@ -286,11 +569,13 @@ def simulate_solutions(run_list, result_set='full_results', no_control_runs=[],
     epidemic_simulators = {}
     policy_controls = {}
     no_control_policy = Policy({10000: 0}, {10000: 0})
+    cache = SimulationCache(cache_dir)
 
     for run in run_list:
         print("simulating policies for ", run)
 
         model, model_case, policy_control = create_simu_run(**run_list[run])
+        model.set_prefix_reuse(prefix_nodes)
 
         epidemic_simulators[run] = (model, model_case)
         policy_controls[run] = policy_control  # ToDo: check if redundant
@@ -301,7 +586,8 @@ def simulate_solutions(run_list, result_set='full_results', no_control_runs=[],
             no_control_sim_data[run] = epidemic_simulators[run][0].solve_case(epidemic_simulators[run][1],
                                                                               no_control_policy)
         else:
-            run_result_df = pd.read_csv('active_results/' + run + '_' + result_set + '.csv', delimiter=',', index_col=0)
+            run_result_path = 'active_results/' + run + '_' + result_set + '.csv'
+            run_result_df = pd.read_csv(run_result_path, delimiter=',', index_col=0)
 
             # if certain policy set is given (as opposed to default [] meaning 'all')
             # only the policies corresponding to indices in the policy set are used (others discarded).
@@ -310,7 +596,9 @@ def simulate_solutions(run_list, result_set='full_results', no_control_runs=[],
 
             run_obj_df = run_result_df[['Deaths', 'Economic impact']]
             run_policies_df = run_result_df.drop(columns=['Deaths', 'Economic impact'])
-            run_policies = run_policies_df.to_numpy()
+            schema = read_policy_schema(run_result_path, run_policies_df.columns)
+            run_policies = schema.values(run_policies_df)
+            run_hash = run_parameters_hash(simulation_parameters(run_list[run]))
 
             try:
                 lockdown_only = (run_list[run]['testing_policy_control_days'] == "NA")
@@ -323,48 +611,42 @@ def simulate_solutions(run_list, result_set='full_results', no_control_runs=[],
                 testing_only = False
 
             if lockdown_only:
-                ld_control_times = list(
-                    map(int, [eval(tup)[1] for tup in run_policies_df.columns if (eval(tup)[0] == 'ld')]))
-
-                policies[run] = {}
-                policy_sim_data[run] = {}
-
-                for pol_no, pol in enumerate(run_policies):
-                    ld_pol = create_sub_policy(ld_control_times, pol)
-                    test_pol = "NA"
-                    policies[run][pol_no] = create_policy(ld_pol, test_pol)
-                    policy_sim_data[run][pol_no] = epidemic_simulators[run][0].solve_case(epidemic_simulators[run][1],
-                                                                                          policies[run][pol_no])
+                ld_control_times, test_control_times = schema.control_days('ld'), []
+                run_policies = schema.values(run_policies_df, 'ld')
             elif testing_only:
-
-                test_control_times = list(
-                    map(int, [eval(tup)[1] for tup in run_policies_df.columns if (eval(tup)[0] == 'test')]))
-                policies[run] = {}
-                policy_sim_data[run] = {}
-
-                for pol_no, pol in enumerate(run_policies):
-                    test_pol = create_sub_policy(test_control_times, pol)
-                    ld_pol = "NA"
-                    policies[run][pol_no] = create_policy(ld_pol, test_pol)
-                    policy_sim_data[run][pol_no] = epidemic_simulators[run][0].solve_case(epidemic_simulators[run][1],
-                                                                                          policies[run][pol_no])
-
+                ld_control_times, test_control_times = [], schema.control_days('test')
+                run_policies = schema.values(run_policies_df, 'test')
             else:
-                ld_control_times = list(
-                    map(int, [eval(tup)[1] for tup in run_policies_df.columns if (eval(tup)[0] == 'ld')]))
-                test_control_times = list(
-                    map(int, [eval(tup)[1] for tup in run_policies_df.columns if (eval(tup)[0] == 'test')]))
-
-                policies[run] = {}
-                policy_sim_data[run] = {}
-
-                for pol_no, pol in enumerate(run_policies):
-                    ld_pol = create_sub_policy(ld_control_times, pol[0:len(ld_control_times)])
-                    test_pol = create_sub_policy(test_control_times, pol[len(ld_control_times):len(pol)])
-
-                    policies[run][pol_no] = create_policy(ld_pol, test_pol)
-                    policy_sim_data[run][pol_no] = epidemic_simulators[run][0].solve_case(epidemic_simulators[run][1],
-                                                                                          policies[run][pol_no])
+                ld_control_times, test_control_times = schema.control_days('ld'), schema.control_days('test')
+
+            policies[run] = {}
+            keys = {}
+            for pol_no, pol in enumerate(run_policies):
+                ld_pol = create_sub_policy(ld_control_times, pol[0:len(ld_control_times)]) if ld_control_times else "NA"
+                test_pol = create_sub_policy(test_control_times, pol[len(ld_control_times):len(pol)]) \
+                    if test_control_times else "NA"
+                policies[run][pol_no] = create_policy(ld_pol, test_pol)
+                keys[pol_no] = cache.key(run_hash, pol, ld_control_times, test_control_times)
+
+            # policies not in the cache yet, duplicates are simulated once
+            missing = OrderedDict((keys[pol_no], pol_no) for pol_no in keys if keys[pol_no] not in cache)
+            if len(missing) > 0:
+                print(len(missing), "of", len(keys), "policies not in the cache, simulating")
+                X = run_policies[list(missing.values())]
+                missing_keys = list(missing.keys())
+                batches = [(X[i:i + batch_size], missing_keys[i:i + batch_size], ld_control_times, test_control_times)
+                           for i in range(0, len(X), batch_size)]
+                if workers > 1:
+                    pool = Pool(workers, initializer=_init_worker_simu_run,
+                                initargs=(run_list[run], prefix_nodes, cache_dir))
+                    pool.starmap(_simulate_to_cache_worker, batches)
+                    pool.close()
+                    pool.join()
+                else:
+                    for batch in batches:
+                        simulate_to_cache(model, model_case, cache, *batch)
+
+            policy_sim_data[run] = LazySimulationResults(cache, keys)
 
     print("Done.")
     return policies, policy_obj_values, policy_sim_data, epidemic_simulators
@@ -384,31 +666,56 @@ def simulate_sample(run, runs, sample_df, sample_id, policy):
     # calculate results
 
     epidemic_simulator = create_epidemic_model(**sample_run_params)
-    Reported_D, Notinfected_D, Unreported_D, Infected_D, \
-    False_pos, False_neg, Recovered_D, Dead_D, Infected_T, Infected_not_Q, Infected_in_Q, Y_D, M_t, Y_total, total_testing_cost, tests, Unk_NA_nQ_D, Unk_NA_Q_D, K_NA_nQ_D, Unk_IA_nQ_D, Unk_IA_Q_D, K_IA_Q_D, alpha_D, ksi_TT_I_D, ksi_TT_N_D, ksi_TT_R_D, Symptomatic_D \
-        = epidemic_simulator[0].solve_case(epidemic_simulator[1], policy)
-
-    return Reported_D, Notinfected_D, Unreported_D, Infected_D, \
-    False_pos, False_neg, Recovered_D, Dead_D, Infected_T, Infected_not_Q, Infected_in_Q, Y_D, M_t, Y_total, total_testing_cost, tests, Unk_NA_nQ_D, Unk_NA_Q_D, K_NA_nQ_D, Unk_IA_nQ_D, Unk_IA_Q_D, K_IA_Q_D, alpha_D, ksi_TT_I_D, ksi_TT_N_D, ksi_TT_R_D, Symptomatic_D \
 
+    # SimulationResult with all outputs, see optimizable_corona_model.solve_case
+    return epidemic_simulator[0].solve_case(epidemic_simulator[1], policy)
+
+
+def non_dominated_indices(F, obj_dir, block_size=256):
+    # indices (ascending) of the rows of objective array F (solutions, objectives) not dominated by any other row.
+    # obj_dir: direction of each objective, 1 = larger is better, -1 = smaller is better. Row i is dominated if some
+    # row is strictly better in all objectives. Rows with NaN objectives are kept and do not dominate other rows.
+    F = np.asarray(F, dtype=float)
+    if F.ndim == 1:
+        F = F[:, None]
+    G = -np.asarray(obj_dir, dtype=float) * F  # smaller is better in all objectives
+    valid = np.flatnonzero(~np.isnan(G).any(axis=1))
+    G = G[valid]
+    n_valid = len(valid)
+    dominated = np.zeros(n_valid, dtype=bool)
+
+    if n_valid > 0 and G.shape[1] == 2:
+        # sweep in order of the first objective: a row is dominated if a row with a strictly smaller first objective
+        # has a strictly smaller second objective
+        order = np.lexsort((G[:, 1], G[:, 0]))
+        g0, g1 = G[order, 0], G[order, 1]
+        best_g1 = np.minimum.accumulate(g1)
+        first = np.searchsorted(g0, g0, side='left')  # first row with the same first objective value
+        best_before = np.where(first > 0, best_g1[np.maximum(first - 1, 0)], np.inf)
+        dominated[order] = best_before < g1
+
+    elif n_valid > 0:
+        # blocks in order of the first objective: a row can only be dominated by rows before it in this order, and
+        # (domination being transitive) by a non-dominated one. Each block is compared with the non-dominated rows
+        # of earlier blocks and with itself.
+        order = np.argsort(G[:, 0], kind='stable')
+        front = np.empty((0, G.shape[1]))
+        for start in range(0, n_valid, block_size):
+            block = order[start:start + block_size]
+            candidates = np.concatenate([front, G[block]])
+            block_dominated = np.any(np.all(candidates[None, :, :] < G[block][:, None, :], axis=2), axis=1)
+            dominated[block] = block_dominated
+            front = np.concatenate([front, G[block][~block_dominated]])
+
+    keep = np.ones(len(F), dtype=bool)
+    keep[valid[dominated]] = False
+    return np.flatnonzero(keep)
 
 def remove_dominated(data, obj_columns, obj_dir):
-    non_dom = data.copy()
+    # rows of data not dominated by other rows in the objective columns, see non_dominated_indices. As before, the
+    # index of data is reset to row positions, and the returned rows keep their positions as index.
     n_policies = len(data.index)
-    n_obj = len(obj_columns)
     data.index = list(range(n_policies))
-    non_dom.index = list(range(n_policies))
-    for i in non_dom.index:
-        non_dom_sol = True
-        for j in data.index:
-            if j != i:
-                comparison = np.zeros(n_obj)
-                for oi, o in enumerate(obj_columns):
-                    comparison[oi] = obj_dir[oi] * (non_dom.loc[i, o] - data.loc[j, o])
-                if np.max(comparison) < 0:
-                    non_dom_sol = False
-
-        if not non_dom_sol:
-            non_dom = non_dom.drop(index=i)
-
-    return non_dom
+    keep = non_dominated_indices(data[obj_columns].to_numpy(dtype=float), obj_dir)
+
+    return data.iloc[keep].copy()
@@ -1,5 +1,6 @@
 from policy_epidemic_model_code import *
 from jupyterWidgets import *
+from risk_tools import load_risk_samples, risk_store_path
 
 import numpy as np
 import importlib
@@ -41,6 +42,9 @@ output_names = {
     27: "Dead (cumulative, time step)"
 }
 
+# SimulationResult field name of each output above, e.g. result[7] is result.Dead_D
+output_fields = dict(enumerate(SimulationResult.fields))
+
 run_labels = {
     'base_case_no_control':         'no control',
     'base_case_no_control_R0_4.0':      'no control with R0=4.0',
@@ -276,7 +280,10 @@ short_run_labels = {
 
 
 def epidemic_progression_plot(outputs, epidemic_sims, runs_data, columns=2, policies="NA"):
+    # outputs: output indices (see output_names) or SimulationResult field names (see output_fields), runs_data:
+    # SimulationResult of each run
 
+    outputs = [SimulationResult.fields.index(output) if isinstance(output, str) else output for output in outputs]
     rows = int(np.ceil(len(outputs)/columns))
     #empty = rows*columns - len(outputs)
     #fills = [-1]*empty
@@ -291,7 +298,7 @@ def epidemic_progression_plot(outputs, epidemic_sims, runs_data, columns=2, poli
                 secax = axes[row, col].twinx()
             for run in runs_data:
                 time_steps = range(0, epidemic_sims[run][0].T_years*365)
-                axes[row,col].plot(time_steps, runs_data[run][outputs_array[row,col]], label=short_run_labels[run])
+                axes[row,col].plot(time_steps, runs_data[run][output_fields[outputs_array[row,col]]], label=short_run_labels[run])
                 axes[row,col].set_xlabel('time (days)')
                 #axes[row,col].set_ylabel(output_names[outputs_array[row,col]])
 
@@ -337,12 +344,13 @@ def pareto_plot(runs, obj_dict):
     return fig
 
 
-def sample_clouds(run, result_set, cols=2):
+def sample_clouds(run, result_set, cols=2, file_suffix=''):
     medoid_solutions = {}
     medoid_obj = {}
     sample_obj = {}
 
-    medoid_df = pd.read_csv('active_results/risk_analysis/' + run + '_' + result_set + '_risk.csv', delimiter=',')
+    medoid_df = pd.read_csv('active_results/risk_analysis/' + run + '_' + result_set + '_risk' + file_suffix + '.csv',
+                            delimiter=',')
     medoid_obj[run] = medoid_df[['Deaths', 'Economic impact']]
     medoid_solutions[run] = medoid_df.drop(columns=['Deaths', 'Economic impact'])
 
@@ -353,14 +361,16 @@ def sample_clouds(run, result_set, cols=2):
 
     sample_obj[run] = {}
 
+    # sample objectives of all policies, read from the run's sample store
+    samples = load_risk_samples(risk_store_path(run, result_set, file_suffix), columns=['Deaths', 'Output'])
+
     fig, axes = plt.subplots(nrows=rows, ncols=cols, figsize=(20, 10))
 
     for row in range(0, rows):
         for col in range(0, cols):
             i = row * cols + col
 
-            sample_df = pd.read_csv('active_results/risk_analysis/' + run + '__' + str(i) + '.csv', delimiter=',')
-            sample_obj[run][i] = sample_df[['Deaths', 'Output']]
+            sample_obj[run][i] = pd.DataFrame({'Deaths': samples['Deaths'][i], 'Output': samples['Output'][i]})
 
             index = medoid_df.index[i]
 